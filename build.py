@@ -0,0 +1,319 @@
+from __future__ import division
+
+import getopt
+import multiprocessing
+import multiprocessing.connection
+import sys
+import time
+import traceback
+
+import datacache
+import manifest
+import plot
+from covid_data import CovidData
+from map import MapData
+from plot import CovidCases
+
+# Build all the generated files (plots, maps and html) in a single run.
+#
+# The build is split into stages, each of which lists the stages that it
+# depends on. The data is loaded once and each stage is run as soon as all of
+# its dependencies have completed, so stages that don't depend on each other
+# (like the maps and the top-N plots) can run at the same time.
+#
+# Stages that only generate output files are run in a forked process (which
+# gets a copy of all the data calculated by the earlier stages). Stages that
+# calculate data that is needed by later stages are run in this process.
+
+# A stage in the build. |func| is called once all the stages in |deps| have
+# completed. If |fork| is True, the stage only generates output files and can
+# be run in a separate process.
+class Stage:
+	def __init__(self, name, deps, func, fork):
+		self.name = name
+		self.deps = deps
+		self.func = func
+		self.fork = fork
+
+class Build:
+	def __init__(self, date, ranking_days):
+		self.date = date
+		self.ranking_days = ranking_days
+		self.gen_animated = False
+		self.gen_hospital = False
+		self.gen_maps = True
+		self.gen_plots = True
+		self.export_rankings = True
+
+		self.covid_data = None
+		self.cases = None
+		self.map_data = None
+
+	# Return the list of stages for the build.
+	def calc_stages(self):
+		stages = []
+		stages.append(Stage('us-data', [], self.load_us_data, False))
+		if self.export_rankings:
+			stages.append(Stage('export-rankings', ['us-data'], self.export_state_rankings, True))
+		stages.append(Stage('top-n-data', ['us-data'], self.calc_top_n, False))
+		if self.export_rankings:
+			stages.append(Stage('export-plot-data', ['top-n-data'], self.export_plot_data, True))
+		if self.gen_plots:
+			stages.append(Stage('top-n', ['top-n-data'], self.generate_top_n, True))
+			if self.gen_hospital:
+				stages.append(Stage('hospital', ['top-n-data'], self.generate_hospital, True))
+			stages.append(Stage('combined', ['top-n-data'], self.generate_combined, True))
+			stages.append(Stage('individual', ['top-n-data'], self.generate_individual, True))
+		stages.append(Stage('state-ranks', ['top-n-data'], self.calc_state_ranks, False))
+		if self.gen_plots:
+			stages.append(Stage('ranking', ['state-ranks'], self.generate_ranking, True))
+		stages.append(Stage('test-page-html', ['top-n-data'], self.create_test_page_html, True))
+
+		state_html_deps = ['state-ranks']
+		if self.gen_maps:
+			stages.append(Stage('map-data', [], self.load_map_data, False))
+			stages.append(Stage('us-maps', ['map-data'], self.generate_us_maps, True))
+			stages.append(Stage('state-maps', ['map-data'], self.generate_state_maps, True))
+			state_html_deps.append('state-maps')
+		stages.append(Stage('state-html', state_html_deps, self.create_state_html, True))
+
+		if self.gen_plots and self.gen_animated:
+			stages.append(Stage('anim', ['top-n-data'], self.generate_anims, True))
+		return stages
+
+	def load_us_data(self):
+		self.covid_data = CovidData(self.date)
+		self.covid_data.load_data()
+
+	def export_state_rankings(self):
+		self.covid_data.export_rankings()
+
+	def calc_top_n(self):
+		self.cases = CovidCases(self.covid_data, self.ranking_days)
+		print('Processing data for', self.cases.date_str)
+		self.cases.calc_top_n()
+
+	def export_plot_data(self):
+		self.cases.export_plot_data()
+
+	def generate_top_n(self):
+		self.cases.generate_top_n_plots()
+
+	def generate_hospital(self):
+		self.cases.calc_top_n_hospital()
+		self.cases.generate_top_n_plots(self.cases.hospital_plots)
+
+	def generate_combined(self):
+		self.cases.generate_states_combined()
+
+	def generate_individual(self):
+		self.cases.generate_states_individual()
+
+	def calc_state_ranks(self):
+		self.cases.calc_state_ranks()
+
+	def generate_ranking(self):
+		self.cases.calc_ranking_plot()
+
+	def create_test_page_html(self):
+		self.cases.create_test_page_html()
+
+	def create_state_html(self):
+		self.cases.create_state_html()
+
+	def generate_anims(self):
+		self.cases.generate_top_n_anims()
+
+	def load_map_data(self):
+		# The maps use 'yyyy-mm-dd' dates.
+		map_date = None
+		if self.date:
+			map_date = '%s-%s-%s' % (self.date[0:4], self.date[4:6], self.date[6:8])
+		self.map_data = MapData(False)
+		self.map_data.load_census()
+		self.map_data.load_nyt(map_date)
+		self.map_data.scan_svg()
+		self.map_data.check_data()
+
+	def generate_us_maps(self):
+		self.map_data.generate_map_cases()
+		self.map_data.generate_map_deaths()
+
+	def generate_state_maps(self):
+		self.map_data.generate_state_maps()
+
+# Run |stage| in this process. Returns True if it succeeded.
+# Some of the data loading code calls exit() when it finds a problem, which
+# should only fail the stage and not stop the rest of the build.
+def run_stage(stage):
+	start = time.time()
+	try:
+		stage.func()
+	except (Exception, SystemExit):
+		traceback.print_exc()
+		print('ERROR - stage failed:', stage.name)
+		return False
+	print('Finished %s (%.1fs)' % (stage.name, time.time() - start))
+	return True
+
+# Entry point for a forked stage, which can use up to |num_jobs| processes to
+# generate its plots. The changes to the build manifest are sent back to the
+# main process through |conn|.
+def run_stage_process(stage, num_jobs, conn):
+	plot._num_jobs = num_jobs
+	# Drop the changes that were inherited from the main process.
+	manifest.take_changes()
+	ok = run_stage(stage)
+	conn.send([ok, manifest.take_changes()])
+	conn.close()
+
+# Run all the |stages|, using up to |num_jobs| processes for the forked stages.
+# Stages are started in order as soon as their dependencies are done, and the
+# available processes are split between the stages that are ready to run (so
+# that each stage's plots are generated with its share of the processes).
+# Returns True if all the stages succeeded.
+def run_stages(stages, num_jobs):
+	use_fork = 'fork' in multiprocessing.get_all_start_methods()
+	if use_fork:
+		ctx = multiprocessing.get_context('fork')
+		# Load the manifest once so that each stage doesn't need to reload it.
+		manifest.get_entries()
+
+	pending = list(stages)
+	done = set()
+	failed = set()
+	running = {}
+	while pending or running:
+		for s in list(pending):
+			if any([d in failed for d in s.deps]):
+				print('ERROR - skipping stage', s.name, 'since a dependency failed')
+				pending.remove(s)
+				failed.add(s.name)
+		ready = [s for s in pending if all([d in done for d in s.deps])]
+
+		# Start the forked stages first so that they can run while this process
+		# is busy with the other stages.
+		ready_forked = [s for s in ready if use_fork and s.fork]
+		for i in range(0, len(ready_forked)):
+			available = num_jobs - sum([r[2] for r in running.values()])
+			if available < 1:
+				break
+			s = ready_forked[i]
+			stage_jobs = max(1, available // (len(ready_forked) - i))
+			print('Starting', s.name)
+			(parent_conn, child_conn) = ctx.Pipe(duplex=False)
+			p = ctx.Process(target=run_stage_process, args=(s, stage_jobs, child_conn))
+			p.start()
+			child_conn.close()
+			running[parent_conn] = (s, p, stage_jobs)
+			pending.remove(s)
+
+		local = [s for s in ready if s in pending and (not use_fork or not s.fork)]
+		if local:
+			s = local[0]
+			pending.remove(s)
+			if run_stage(s):
+				done.add(s.name)
+			else:
+				failed.add(s.name)
+			continue
+
+		if not running:
+			for s in pending:
+				print('ERROR - unable to run stage', s.name, '- missing dependency')
+				failed.add(s.name)
+			break
+
+		for conn in multiprocessing.connection.wait(list(running.keys())):
+			(s, p, stage_jobs) = running.pop(conn)
+			try:
+				(ok, changes) = conn.recv()
+			except EOFError:
+				ok = False
+				changes = {}
+				print('ERROR - stage exited unexpectedly:', s.name)
+			conn.close()
+			p.join()
+			manifest.merge_changes(changes)
+			if ok:
+				done.add(s.name)
+			else:
+				failed.add(s.name)
+
+	return len(failed) == 0
+
+def usage():
+	print('build.py [options]')
+	print('where options are:')
+	print('  --anim Generate animated plots for top-N')
+	print('  --date <yyyymmdd> Only use data up to date')
+	print('  --force Regenerate all outputs, even if they are up to date')
+	print('  --hospital Generate top-N plots for hospitalizations and ICU')
+	print('  --html-only Only generate the data and html files (no plots or maps)')
+	print('  --jobs <n> Number of processes to use for the stages and their plots (default 1)')
+	print('  --no-cache Parse the input data files and render all animation frames instead of using the cache')
+	print('  --no-export Don\'t export the state ranking CSV/HTML files or the plot data')
+	print('  --no-maps Don\'t generate the maps')
+	print('  --ranking-days <n> Number of days to show in state ranking plots (default 31)')
+	sys.exit(1)
+
+def main(argv):
+	try:
+		opts, args = getopt.getopt(argv,
+				"?hnd:",
+				["?", "help", "anim", "date=", "force", "hospital", "html-only", "jobs=", "no-cache", "no-export", "no-maps",
+				 "ranking-days="])
+	except getopt.GetoptError:
+		usage()
+
+	date = None
+	num_jobs = 1
+	ranking_days = 31
+	gen_animated = False
+	gen_hospital = False
+	gen_maps = True
+	gen_plots = True
+	export_rankings = True
+	for opt, arg in opts:
+		if opt in ("-?", "-h", "--?", "--help"):
+			usage()
+		if opt in ("-n", "--anim"):
+			gen_animated = True
+		if opt in ("-d", "--date"):
+			date = arg
+		if opt == "--force":
+			manifest.enabled = False
+		if opt == "--hospital":
+			gen_hospital = True
+		if opt == "--html-only":
+			gen_maps = False
+			gen_plots = False
+		if opt == "--jobs":
+			num_jobs = int(arg)
+		if opt == "--no-cache":
+			datacache.enabled = False
+		if opt == "--no-export":
+			export_rankings = False
+		if opt == "--no-maps":
+			gen_maps = False
+		if opt == "--ranking-days":
+			ranking_days = int(arg)
+
+	# For stages that are run in this process. Each forked stage is given its
+	# share of the processes by |run_stages|.
+	plot._num_jobs = num_jobs
+
+	build = Build(date, ranking_days)
+	build.gen_animated = gen_animated
+	build.gen_hospital = gen_hospital
+	build.gen_maps = gen_maps
+	build.gen_plots = gen_plots
+	build.export_rankings = export_rankings
+
+	ok = run_stages(build.calc_stages(), num_jobs)
+	manifest.report()
+	if not ok:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,11 +1,116 @@
 from __future__ import division
 
+import copy
+import datetime
+import io
 import math
+import numpy
 import os
-import shutil
 
+import datacache
+import growth
+import manifest
+from csvdata import parse_csv_columns, read_csv_columns, to_ints
+from timeseries import TimeSeriesStore, calc_rank_matrix, store_from_arrays
 from usinfo import USInfo
 
+# Metrics recorded for each state in the time series store.
+#   tests_pn - positive + negative tests
+#   tests_pnp - positive + negative + pending tests
+METRICS = ['tests_pn', 'tests_pnp', 'cases', 'deaths']
+
+us_data = 'data/states-daily.csv'
+italy_data = 'data/dpc-covid19-ita-andamento-nazionale.csv'
+
+# Known set of fields in the US data. Fields are located by name, so changes to
+# this list are reported as warnings rather than errors.
+# 21Mar2020: New field: hospitalized
+# 25Mar2020: New fields: totalTestResults,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
+# 27Mar2020: New field: fips
+# 28Mar2020: New field: hash
+#  4 May 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,hash,dateChecked,death,hospitalized,total,totalTestResults,posNeg,fips,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
+#  5 May 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,hash,dateChecked,death,hospitalized,total,totalTestResults,posNeg,fips,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
+#  2 Jun 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
+# 10 Jun 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,totalTestsViral,positiveTestsViral,negativeTestsViral,positiveCasesViral,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
+# 23 Jul 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,totalTestsViral,positiveTestsViral,negativeTestsViral,positiveCasesViral,deathConfirmed,deathProbable,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
+US_FIELDS = [
+	'date',
+	'state',
+	'positive',
+	'negative',
+	'pending',
+	'hospitalizedCurrently',
+	'hospitalizedCumulative',
+	'inIcuCurrently',
+	'inIcuCumulative',
+	'onVentilatorCurrently',
+	'onVentilatorCumulative',
+	'recovered',
+	'dataQualityGrade',  # Added 5 May 2020
+	'lastUpdateEt',  # Added 5 May 2020
+	'dateModified',  # Added 2 Jun 2020
+	'checkTimeEt',  # Added 2 Jun 2020
+	# Many fields after this point were moved around on 2 Jun 2020
+	'death',
+	'hospitalized',
+	'dateChecked',
+	'totalTestsViral',  # Added 10 Jun 2020
+	'positiveTestsViral',  # Added 10 Jun 2020
+	'negativeTestsViral',  # Added 10 Jun 2020
+	'positiveCasesViral',  # Added 10 Jun 2020
+	'deathConfirmed',  # Added 9 Jul 2020
+	'deathProbable',  # Added 9 Jul 2020
+	'fips',
+	'positiveIncrease',
+	'negativeIncrease',
+	'total',  # deprecated (= positive + negative + pending)
+	          # Will be removed at some point because |pending| is not consistent between states.
+	'totalTestResults',
+	'totalTestResultsIncrease',
+	'posNeg',
+	'deathIncrease',
+	'hospitalizedIncrease',
+	'hash',
+	'commercialScore',  # Added 2 Jun 2020
+	'negativeRegularScore',  # Added 2 Jun 2020
+	'negativeScore',  # Added 2 Jun 2020
+	'positiveScore',  # Added 2 Jun 2020
+	'score',  # Added 2 Jun 2020
+	'grade',  # Added 2 Jun 2020
+]
+
+# Metrics recorded for Italy.
+ITALY_METRICS = ['tests', 'cases', 'deaths']
+
+# Hypothetical Italy data for the days before the data starts, back to roughly
+# 100 total cases (for alignment). Each entry is [tests, cases, deaths].
+ITALY_LEAD_IN = [[0, 120, 0], [0, 180, 0]]
+
+# Known set of fields in the Italy data. As with the US data, fields are
+# located by name so changes here are reported as warnings.
+# 31 Mar 2020 - totale_attualmente_positivi,nuovi_attualmente_positivi split into totale_positivi,variazione_totale_positivi,nuovi_positivi
+# 20 Apr 2020 - Added casi_testati
+#  1 Jul 2020 - Added casi_da_sospetto_diagnostico,casi_da_screening. note_it,note_en merged into note
+ITALY_FIELDS = [
+	'data',  # date and time: yyyy-mm-ddThh:mm:ss
+	'stato',  # state (always ITA)
+	'ricoverati_con_sintomi',  # hospitalized with symptoms
+	'terapia_intensiva',  # intensive care
+	'totale_ospedalizzati',  # total hospitalized
+	'isolamento_domiciliare',  # home isolation
+	'totale_positivi',  # total positive
+	'variazione_totale_positivi',  # change total positive
+	'nuovi_positivi',  # new positive
+	'dimessi_guariti',  # discharged healed
+	'deceduti',  # deceased
+	'casi_da_sospetto_diagnostico',  # Added 1 Jul 2020
+	'casi_da_screening',  # Added 1 Jul 2020
+	'totale_casi',  # total cases
+	'tamponi',  # swabs
+	'casi_testati',  # cases tested
+	'note',  # Added 1 Jul 2020
+]
+
 # Notes on data
 # Changes in 20200319 dataset:
 # Other notes:
@@ -13,291 +118,307 @@ from usinfo import USInfo
 class CovidData:
 	def __init__(self, date):
 		self.date = date
-		self.state_tests_pn = {}
-		self.state_tests_pnp = {}
-		self.state_cases = {}
-		self.state_deaths = {}
+		self.store = None
+		self.rankings = {}
+		self.rank_matrices = {}
+		self.growth_metrics = {}
+		self.column_stores = {}
 
 	def get_us_tests_pn(self):
-		return self.us_tests_pn
+		return self.store.total('tests_pn')
 	
 	def get_us_tests_pnp(self):
-		return self.us_tests_pnp
+		return self.store.total('tests_pnp')
 	
 	def get_us_cases(self):
-		return self.us_cases
+		return self.store.total('cases')
 	
 	def get_us_deaths(self):
-		return self.us_deaths
+		return self.store.total('deaths')
 
 	def get_state_tests_pn(self, state):
-		return self.state_tests_pn[state]
+		return self.store.series(state, 'tests_pn')
 		
 	def get_state_tests_pnp(self, state):
-		return self.state_tests_pnp[state]
+		return self.store.series(state, 'tests_pnp')
 
 	def get_state_cases(self, state):
-		return self.state_cases[state]
+		return self.store.series(state, 'cases')
 	
 	def get_state_deaths(self, state):
-		return self.state_deaths[state]
+		return self.store.series(state, 'deaths')
 	
 	def get_italy_tests(self):
-		return self.italy_tests
+		return self.get_italy_data('tests')
 
 	def get_italy_cases(self):
-		return self.italy_cases
+		return self.get_italy_data('cases')
 
 	def get_italy_deaths(self):
-		return self.italy_deaths
+		return self.get_italy_data('deaths')
 
 	def get_test_rank(self):
-		return self.ranking_test
+		return self.get_ranking('tests').ranking
 
 	def get_test_rank_norm(self):
-		return self.ranking_test_norm
+		return self.get_ranking('tests').ranking_norm
 	
 	def get_case_rank(self):
-		return self.ranking_case
+		return self.get_ranking('cases').ranking
 
 	def get_case_rank_norm(self):
-		return self.ranking_case_norm
+		return self.get_ranking('cases').ranking_norm
 	
 	def get_death_rank(self):
-		return self.ranking_death
+		return self.get_ranking('deaths').ranking
 
 	def get_death_rank_norm(self):
-		return self.ranking_death_norm
+		return self.get_ranking('deaths').ranking_norm
+
+	# Return the state ranking for |type| ('tests', 'cases' or 'deaths').
+	# The ranking is calculated the first time that it is requested.
+	def get_ranking(self, type):
+		if not type in self.rankings:
+			if type == 'tests':
+				self.rankings[type] = self.rank_states_tests()
+			elif type == 'cases':
+				self.rankings[type] = self.rank_states_cases()
+			else:
+				self.rankings[type] = self.rank_states_deaths()
+		return self.rankings[type]
 	
 	def get_date(self):
 		return self.date
 	
-	def remove_last_day(self):
-		self.dates.pop()
-		self.date = self.dates[-1]
-		
-		self.us_tests_pn.pop()
-		self.us_tests_pnp.pop()
-		self.us_cases.pop()
-		self.us_deaths.pop()
-		self.italy_tests.pop()
-		self.italy_cases.pop()
-		self.italy_deaths.pop()
-		for s in USInfo.states:
-			self.state_tests_pn[s].pop()
-			self.state_tests_pnp[s].pop()
-			self.state_cases[s].pop()
-			self.state_deaths[s].pop()
+	def get_dates(self):
+		return self.dates
+
+	# Return the series for the given state/US |metric|.
+	# |metric| can be one of METRICS or the name of any numeric column in the
+	# US data (see |get_metric_store|).
+	def get_state_data(self, metric, state):
+		store = self.get_metric_store(metric)
+		if store is self.store:
+			return store.series(state, metric)
+		return store.series(state, metric).astype(numpy.int64)
+
+	def get_us_data(self, metric):
+		return self.get_metric_store(metric).total(metric)
+
+	# Return the store that contains |metric|.
+	# Metrics other than those in METRICS are loaded from the US data file the
+	# first time that they are used and stored separately (as int32 values with
+	# a missing mask) so that only the columns that are used take up memory.
+	def get_metric_store(self, metric):
+		if metric in METRICS:
+			return self.store
+		if not metric in self.column_stores:
+			self.column_stores[metric] = self.load_us_column(metric)
+		store = self.column_stores[metric]
+		# The column stores always contain the full history of the data.
+		if store.num_dates() != self.store.num_dates():
+			store = store.as_of(self.store.last_date())
+		return store
+
+	# Return the Italy series for |metric| (one of ITALY_METRICS), aligned with
+	# the US dates. Dates without Italy data are 0.
+	def get_italy_data(self, metric):
+		return self.italy.series('ITA', metric)
+
+	# Return a view of the data as of |date|, ignoring all later dates.
+	# The view shares the underlying data with this object, which is unchanged.
+	def as_of(self, date):
+		view = copy.copy(self)
+		view.store = self.store.as_of(date)
+		view.dates = view.store.dates
+		view.date = view.store.last_date()
+		view.rankings = {}
+		view.rank_matrices = {}
+		view.growth_metrics = {}
+		view.italy = self.italy.as_of(date)
+		return view
 	
 	def load_data(self):
 		self.load_us_data()
 		self.load_italy_data()
 	
 	def load_us_data(self):
-		self.state_tests_pn = {}  # pos + neg
-		self.state_tests_pnp = {}  # pos + neg + pend
-		self.state_cases = {}
-		self.state_deaths = {}
 		self.states_with_pending = {}
-		for state in USInfo.states:
-			self.state_tests_pn[state] = []
-			self.state_tests_pnp[state] = []
-			self.state_cases[state] = []
-			self.state_deaths[state] = []
-		self.us_tests_pn = []
-		self.us_tests_pnp = []
-		self.us_cases = []
-		self.us_deaths = []
-		
-		curr_date = None
-		self.dates = []
-		state_has_data = {}
-		us_tests_pn = 0
-		us_tests_pnp = 0
-		us_cases = 0
-		us_deaths = 0
-		
-		#  4 May 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,hash,dateChecked,death,hospitalized,total,totalTestResults,posNeg,fips,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
-		#  5 May 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,hash,dateChecked,death,hospitalized,total,totalTestResults,posNeg,fips,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
-		#  2 Jun 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
-		# 10 Jun 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,totalTestsViral,positiveTestsViral,negativeTestsViral,positiveCasesViral,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
-		# 23 Jul 2020: date,state,positive,negative,pending,hospitalizedCurrently,hospitalizedCumulative,inIcuCurrently,inIcuCumulative,onVentilatorCurrently,onVentilatorCumulative,recovered,dataQualityGrade,lastUpdateEt,dateModified,checkTimeEt,death,hospitalized,dateChecked,totalTestsViral,positiveTestsViral,negativeTestsViral,positiveCasesViral,deathConfirmed,deathProbable,fips,positiveIncrease,negativeIncrease,total,totalTestResults,totalTestResultsIncrease,posNeg,deathIncrease,hospitalizedIncrease,hash,commercialScore,negativeRegularScore,negativeScore,positiveScore,score,grade
-		fields = [
-			'date',
-			'state',
-			'positive',
-			'negative',
-			'pending',
-			'hospitalizedCurrently',
-			'hospitalizedCumulative',
-			'inIcuCurrently',
-			'inIcuCumulative',
-			'onVentilatorCurrently',
-			'onVentilatorCumulative',
-			'recovered',
-			'dataQualityGrade',  # Added 5 May 2020
-			'lastUpdateEt',  # Added 5 May 2020
-			'dateModified',  # Added 2 Jun 2020
-			'checkTimeEt',  # Added 2 Jun 2020
-			# Many fields after this point were moved around on 2 Jun 2020
-			'death',
-			'hospitalized',
-			'dateChecked',
-			'totalTestsViral',  # Added 10 Jun 2020
-			'positiveTestsViral',  # Added 10 Jun 2020
-			'negativeTestsViral',  # Added 10 Jun 2020
-			'positiveCasesViral',  # Added 10 Jun 2020
-			'deathConfirmed',  # Added 9 Jul 2020
-			'deathProbable',  # Added 9 Jul 2020
-			'fips',
-			'positiveIncrease',
-			'negativeIncrease',
-			'total',  # deprecated (= positive + negative + pending)
-			          # Will be removed at some point because |pending| is not consistent between states.
-			'totalTestResults',
-			'totalTestResultsIncrease',
-			'posNeg',
-			'deathIncrease',
-			'hospitalizedIncrease',
-			'hash',
-			'commercialScore',  # Added 2 Jun 2020
-			'negativeRegularScore',  # Added 2 Jun 2020
-			'negativeScore',  # Added 2 Jun 2020
-			'positiveScore',  # Added 2 Jun 2020
-			'score',  # Added 2 Jun 2020
-			'grade',  # Added 2 Jun 2020
-		]
-		index = {}
-		for i in range(0, len(fields)):
-			index[fields[i]] = i
-		with open('data/states-daily.csv') as fp:
-			for line in fp:
-				# 21Mar2020: New field: hospitalized
-				# 25Mar2020: New fields: totalTestResults,deathIncrease,hospitalizedIncrease,negativeIncrease,positiveIncrease,totalTestResultsIncrease
-				# 27Mar2020: New field: fips
-				# 28Mar2020: New field: hash
-				# 02Apr2020:
-				data = line.strip().split(',')
-				if data[0] == 'date':
-					# Verify that fields match expected values.
-					for i in range(0, len(fields)):
-						if data[i] != fields[i]:
-							print('ERROR - changed fields in US data:', fields[i])
-							exit(1)
-					continue
-				date = data[index['date']]
-				state = data[index['state']]
-				positive = int(data[index['positive']]) if data[index['positive']] else 0
-				negative = int(data[index['negative']]) if data[index['negative']] else 0
-				pending = int(data[index['pending']]) if data[index['pending']] else 0
-				death = int(data[index['death']]) if data[index['death']] else 0
-				total_pn = positive + negative
-				total_pnp = positive + negative + pending
-
-				# Ignore all data for dates after the specified date.
-				# Note that the most recent dates appear first in the file.
-				if self.date != None and int(date) > int(self.date):
-					continue
-
-				if curr_date == None:
-					curr_date = date
-					self.dates.insert(0, date)
-				if self.date == None:
-					# Assumes that most recent date is first in file.
-					self.date = date
-
-				# If new date, then make sure we close out the current date,
-				# filling out missing state data with '0's.
-				if curr_date != date:
-					for s in USInfo.states:
-						if not s in state_has_data:
-							self.state_tests_pn[s].insert(0, None)
-							self.state_tests_pnp[s].insert(0, None)
-							self.state_cases[s].insert(0, None)
-							self.state_deaths[s].insert(0, None)
-					# Record total US infos for current date.
-					self.us_tests_pn.insert(0, us_tests_pn)
-					self.us_tests_pnp.insert(0, us_tests_pnp)
-					self.us_cases.insert(0, us_cases)
-					self.us_deaths.insert(0, us_deaths)
-					us_tests_pn = 0
-					us_tests_pnp = 0
-					us_cases = 0
-					us_deaths = 0
-					state_has_data = {}
-					curr_date = date
-					self.dates.insert(0, date)
-
-				self.state_tests_pn[state].insert(0, total_pn)
-				self.state_tests_pnp[state].insert(0, total_pnp)
-				us_tests_pn += total_pn
-				us_tests_pnp += total_pnp
-				
-				self.state_cases[state].insert(0, positive)
-				us_cases += positive
-
-				self.state_deaths[state].insert(0, death)
-				us_deaths += death
-
-				# Keep track of which states have data for this date.
-				state_has_data[state] = True
-		
+
+		# New dates are added to the top of the US data file.
+		arrays = datacache.load_appendable('us-data', us_data, 'prepend',
+				self.parse_us_data, self.update_us_data)
+		self.store = store_from_arrays(arrays)
+
+		# Ignore all data for dates after the specified date.
+		if self.date != None:
+			self.store = self.store.as_of(self.date)
+
 		for s in self.states_with_pending:
 			print('Pending', s, self.states_with_pending[s])
-			
-		# Fill in missing data for final date.
-		for s in USInfo.states:
-			if not s in state_has_data:
-				self.state_tests_pn[s].insert(0, None)
-				self.state_tests_pnp[s].insert(0, None)
-				self.state_cases[s].insert(0, None)
-				self.state_deaths[s].insert(0, None)
-		self.us_tests_pn.insert(0, us_tests_pn)
-		self.us_tests_pnp.insert(0, us_tests_pnp)
-		self.us_cases.insert(0, us_cases)
-		self.us_deaths.insert(0, us_deaths)
-
-		self.rank_states()
+
+		self.dates = self.store.dates
+		if self.date == None:
+			self.date = self.store.last_date()
+		self.rankings = {}
+		self.rank_matrices = {}
+		self.growth_metrics = {}
+		self.column_stores = {}
+
+	# Parse the US data file and return the arrays for the time series store.
+	def parse_us_data(self):
+		with open(us_data, newline='') as fp:
+			return self.build_us_store(fp).to_arrays()
+
+	# Add the new rows in |lines| to the cached US data |arrays|.
+	# Returns None if the new rows include dates that have already been loaded.
+	def update_us_data(self, arrays, lines):
+		return self.append_us_store(arrays, self.build_us_store(lines))
+
+	# Load a single |column| from the US data into a new store.
+	def load_us_column(self, column):
+		arrays = datacache.load_appendable('us-%s' % column, us_data, 'prepend',
+				lambda: self.parse_us_column(column),
+				lambda arrays, lines: self.append_us_store(arrays, self.build_us_column_store(lines, column)))
+		return store_from_arrays(arrays)
+
+	def parse_us_column(self, column):
+		with open(us_data, newline='') as fp:
+			return self.build_us_column_store(fp, column).to_arrays()
+
+	# Build a store for a single |column| from the US data in |lines|.
+	# Blank values are recorded as missing.
+	def build_us_column_store(self, lines, column):
+		data = parse_csv_columns(lines, ['date', 'state', column], None,
+				['date', 'state', column], 'US')
+		dates = []
+		states = []
+		values = []
+		for i in range(0, len(data['date'])):
+			if data[column][i] != '':
+				dates.append(data['date'][i])
+				states.append(data['state'][i])
+				values.append([int(data[column][i])])
+		store = TimeSeriesStore(sorted(set(data['date'])), USInfo.states, [column], numpy.int32)
+		store.set_rows(dates, states, values)
+		return store
+
+	# Add the dates in |new_store| to the store in |arrays|.
+	# Returns None if |new_store| includes dates that are already in |arrays|.
+	def append_us_store(self, arrays, new_store):
+		store = store_from_arrays(arrays)
+		if new_store.num_dates() == 0 or int(new_store.dates[0]) <= int(store.last_date()):
+			return None
+		store.append_store(new_store)
+		return store.to_arrays()
+
+	# Build a time series store from the US data in |lines| (starting with the header).
+	def build_us_store(self, lines):
+		# Only the columns needed for the metrics are loaded. See US_FIELDS
+		# for the full set of columns.
+		data = parse_csv_columns(lines,
+				['date', 'state', 'positive', 'negative', 'pending', 'death'],
+				US_FIELDS, ['date', 'state', 'positive', 'death'], 'US')
+		positive = to_ints(data['positive'])
+		negative = to_ints(data['negative'])
+		pending = to_ints(data['pending'])
+		death = to_ints(data['death'])
+
+		rows = []
+		for i in range(0, len(data['date'])):
+			rows.append([data['date'][i], data['state'][i], positive[i] + negative[i],
+					positive[i] + negative[i] + pending[i], positive[i], death[i]])
+
+		return self.build_store(rows)
+
+	# Build the time series store from the parsed |rows|.
+	# Each row is: [date, state, tests_pn, tests_pnp, cases, deaths]
+	def build_store(self, rows):
+		dates = sorted(set([r[0] for r in rows]))
+		store = TimeSeriesStore(dates, USInfo.states, METRICS)
+		store.set_rows([r[0] for r in rows], [r[1] for r in rows], [r[2:] for r in rows])
+		return store
 	
-	def rank_states(self):
-		self.rank_states_tests()
-		self.rank_states_cases()
-		self.rank_states_deaths()
+	# Return the date x state matrix of values for |metric|, normalized per
+	# million residents if |normalize| is True. Missing values are 0.
+	def get_state_matrix(self, metric, normalize):
+		values = self.get_metric_store(metric).metric_matrix(metric)
+		if not normalize:
+			return values
+		pop = numpy.array([USInfo.state_pop[s] for s in self.store.regions])
+		return (values * 1000000) / pop
+
+	# Return the date x state matrix of state rankings for |metric| (with
+	# 1 = highest value) covering the full history of the data.
+	def get_rank_matrix(self, metric, normalize):
+		key = (metric, normalize)
+		if not key in self.rank_matrices:
+			self.rank_matrices[key] = calc_rank_matrix(self.get_state_matrix(metric, normalize))
+		return self.rank_matrices[key]
+
+	# Return the growth metrics (see |growth.calc_growth_metrics|) for |metric|
+	# as date x state matrices covering the full history of the data.
+	def get_growth_metrics(self, metric):
+		if not metric in self.growth_metrics:
+			store = self.get_metric_store(metric)
+			self.growth_metrics[metric] = growth.calc_growth_metrics(
+					store.metric_matrix(metric), store.metric_missing(metric))
+		return self.growth_metrics[metric]
+
+	# Return the list of states ordered by their most recent value for |metric|.
+	def get_metric_rank(self, metric, normalize):
+		ranks = self.get_rank_matrix(metric, normalize)
+		if len(ranks) == 0:
+			return []
+		return [USInfo.states[i] for i in numpy.argsort(ranks[-1])]
+
+	# Export the state rankings as CSV and HTML files.
+	# This is kept separate from loading the data so that loading doesn't
+	# write any files.
+	def export_rankings(self):
+		for type in ['tests', 'cases', 'deaths']:
+			r = self.get_ranking(type)
+			self.rank_states_data_export(r.data, r.ranking, type,
+					'int', r.label, '', '')
+			self.rank_states_data_export(r.norm_data, r.ranking_norm, '%s-norm' % type,
+					'float', r.label, ', Normalized for Population', '  per million residents')
 
 	def rank_states_tests(self):
 		options = lambda: None  # An object that we can attach attributes to
-		options.state_data = self.state_tests_pn
+		options.metric = 'tests_pn'
 		options.type = 'tests'
 		options.label = 'Tests'
 
-		self.ranking_test, self.ranking_test_norm = self.rank_states_data(options)
+		return self.rank_states_data(options)
 	
 	def rank_states_cases(self):
 		options = lambda: None  # An object that we can attach attributes to
-		options.state_data = self.state_cases
+		options.metric = 'cases'
 		options.type = 'cases'
 		options.label = 'Positive Cases'
-		options.ranking_norm = 'Normalized for Population'
 
-		self.ranking_case, self.ranking_case_norm = self.rank_states_data(options)
+		return self.rank_states_data(options)
 	
 	def rank_states_deaths(self):
 		options = lambda: None  # An object that we can attach attributes to
-		options.state_data = self.state_deaths
+		options.metric = 'deaths'
 		options.type = 'deaths'
 		options.label = 'Deaths'
-		options.ranking_norm = 'Normalized for Population'
 
-		self.ranking_death, self.ranking_death_norm = self.rank_states_data(options)
+		return self.rank_states_data(options)
 	
+	# Calculate the ranking for the most recent date. The results are added
+	# to |options|:
+	#   data/norm_data - dict of state -> value (direct and normalized)
+	#   ranking/ranking_norm - list of states in rank order
 	def rank_states_data(self, options):
 		ranking_data = {}
 		ranking_norm_data = {}
 		for s in USInfo.states:
-			data = options.state_data[s]
+			data = self.store.series(s, options.metric)
 			if len(data) > 0:
 				last = data[-1]
-				if last == None:
+				if self.store.series_missing(s, options.metric)[-1]:
 					print('ERROR ranking', options.type, s, data)
 				ranking_data[s] = last
 				pop = USInfo.state_pop[s]
@@ -310,30 +431,28 @@ class CovidData:
 		out_ranking_norm = []
 		for d in sorted(ranking_norm_data, key=ranking_norm_data.get, reverse=True):
 			out_ranking_norm.append(d)
-		
-		self.rank_states_data_export(ranking_data, out_ranking, options.type,
-				'int', options.label, '', '')
-		self.rank_states_data_export(ranking_norm_data, out_ranking_norm, '%s-norm' % options.type,
-				'float', options.label, ', Normalized for Population', '  per million residents')
 
-		return out_ranking, out_ranking_norm
+		options.data = ranking_data
+		options.norm_data = ranking_norm_data
+		options.ranking = out_ranking
+		options.ranking_norm = out_ranking_norm
+		return options
 	
 	def rank_states_data_export(self, data, ranking, type, format, label, ranking_norm, units):
 		outdir_date = '%s/%s' % (type, self.date)
-		if not os.path.exists(outdir_date):
-			os.makedirs(outdir_date)
+		os.makedirs(outdir_date, exist_ok=True)
 
-		file_csv = '%s/%s-data.csv' % (type, type)
 		# Export ranking.
-		with open(file_csv, 'w') as fp:
-			fp.write('state,%s\n' % type)
-			for state in ranking:
-				if format == 'float':
-					fp.write('{:s},{:.2f}\n'.format(state, data[state]))
-				else:
-					fp.write('{:s},{:d}\n'.format(state, data[state]))
-		shutil.copy(file_csv, '%s/%s-data.csv' % (outdir_date, type))
-		shutil.copy(file_csv, '%s/%s-data.txt' % (type, type))
+		fp = io.StringIO()
+		fp.write('state,%s\n' % type)
+		for state in ranking:
+			if format == 'float':
+				fp.write('{:s},{:.2f}\n'.format(state, data[state]))
+			else:
+				fp.write('{:s},{:d}\n'.format(state, data[state]))
+		manifest.write_text('%s/%s-data.csv' % (type, type), fp.getvalue())
+		manifest.write_text('%s/%s-data.csv' % (outdir_date, type), fp.getvalue())
+		manifest.write_text('%s/%s-data.txt' % (type, type), fp.getvalue())
 
 		d = self.date
 		months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
@@ -345,97 +464,103 @@ class CovidData:
 			extra_info = '<p align=center>Counting positive and negative tests only. Pending tests are not included.</p>\n'
 		file_template = 'state-ranking-template.txt'
 		file_html = 'state-ranking-%s.html' % type
+		fpout = io.StringIO()
 		with open(file_template) as fpin:
-			with open(file_html, 'w') as fpout:
-				for line in fpin:
-					if line.startswith('%%RANKING%%'):
-						fpout.write('<table class="ranking-table">\n')
-						fpout.write('<thead><tr>\n')
-						fpout.write('\t<th>Rank</th>\n')
-						fpout.write('\t<th>State</th>\n')
-						fpout.write('\t<th>%s%s</th>\n' % (label, units))
-						fpout.write('</tr></thead>\n')
-						fpout.write('<tbody>\n')
-						rank = 1
-						for state in ranking:
-							fpout.write('<tr>\n')
-							fpout.write('\t<td>%d</td>\n' % rank)
-							url = 'state/%s/index.html' % state
-							fpout.write('\t<td><a href="%s">%s</a></td>\n' % (url, USInfo.state_name[state]))
-							if format == 'float':
-								fpout.write('\t<td>{:.2f}</td>\n'.format(data[state]))
-							else:
-								fpout.write('\t<td>{:d}</td>\n'.format(data[state]))
-							fpout.write('</tr>\n')
-							rank += 1
-						fpout.write('</tbody>\n')
-						fpout.write('</table>\n')
-					else:
-						line = line.replace('%%DATE%%', date_str)
-						line = line.replace('%%TYPE%%', label)
-						line = line.replace('%%RANKING_NORM%%', ranking_norm)
-						line = line.replace('%%DATAFILE%%', datafile)
-						line = line.replace('%%INFO%%', extra_info)
-						fpout.write(line)
-
-
+			for line in fpin:
+				if line.startswith('%%RANKING%%'):
+					fpout.write('<table class="ranking-table">\n')
+					fpout.write('<thead><tr>\n')
+					fpout.write('\t<th>Rank</th>\n')
+					fpout.write('\t<th>State</th>\n')
+					fpout.write('\t<th>%s%s</th>\n' % (label, units))
+					fpout.write('</tr></thead>\n')
+					fpout.write('<tbody>\n')
+					rank = 1
+					for state in ranking:
+						fpout.write('<tr>\n')
+						fpout.write('\t<td>%d</td>\n' % rank)
+						url = 'state/%s/index.html' % state
+						fpout.write('\t<td><a href="%s">%s</a></td>\n' % (url, USInfo.state_name[state]))
+						if format == 'float':
+							fpout.write('\t<td>{:.2f}</td>\n'.format(data[state]))
+						else:
+							fpout.write('\t<td>{:d}</td>\n'.format(data[state]))
+						fpout.write('</tr>\n')
+						rank += 1
+					fpout.write('</tbody>\n')
+					fpout.write('</table>\n')
+				else:
+					line = line.replace('%%DATE%%', date_str)
+					line = line.replace('%%TYPE%%', label)
+					line = line.replace('%%RANKING_NORM%%', ranking_norm)
+					line = line.replace('%%DATAFILE%%', datafile)
+					line = line.replace('%%INFO%%', extra_info)
+					fpout.write(line)
+		manifest.write_text(file_html, fpout.getvalue())
+
+	# The Italy data is only used for the overlays on the plots, so problems
+	# with it are reported as warnings and the plots are generated without it.
 	def load_italy_data(self):
-		self.italy_tests = []
-		self.italy_cases = []
-		self.italy_deaths = []
-
-		# Hypothetical data back to roughly 100 total cases (for alignment).
-		self.italy_tests.append(0)
-		self.italy_tests.append(0)
-		self.italy_cases.append(120)
-		self.italy_cases.append(180)
-		self.italy_deaths.append(0)
-		self.italy_deaths.append(0)
-
-		with open('data/dpc-covid19-ita-andamento-nazionale.csv') as fp:
-			for line in fp:
-				line = line.strip()
-				if line == '':
-					continue
-				# data,stato,ricoverati_con_sintomi,terapia_intensiva,totale_ospedalizzati,isolamento_domiciliare,totale_positivi,variazione_totale_positivi,nuovi_positivi,dimessi_guariti,deceduti,totale_casi,tamponi,casi_testati,note_it,note_en
-				# data = date and time: yyyy-mm-dd hh:mm:ss
-				# stato = state (always ITA)
-				# ricoverati_con_sintomi = hospitalized with symptoms
-				# terapia_intensiva = intensive care
-				# totale_ospedalizzati = total hospitalized
-				# isolamento_domiciliare = home isolation
-				# totale_positivi - total positive
-				# variazione_totale_positivi - change total positive
-				# nuovi_positivi - new positive
-				# Previously:
-					# totale_attualmente_positivi = total currently positive
-					# nuovi_attualmente_positivi = new currently positive
-				# dimessi_guariti = discharged healed
-				# deceduti = deceased
-				# casi_da_sospetto_diagnostico - added 1 Jul 2020
-				# casi_da_screening - added 1 Jul 2020
-				# totale_casi = total cases
-				# tamponi = swabs
-				# casi_testati = cases tested
-				# note - added 1 Jul 2020, formerly separate
-					# note_it = note italian
-					# note_en = note english
-				# 31 Mar 2020 - Added totale_attualmente_positivi,nuovi_attualmente_positivi split into totale_positivi,variazione_totale_positivi,nuovi_positivi
-				# 20 Apr 2020 - Added casi_testati
-				# 1 Jul 2020 - 
-				(datetime,state,hos,ic,hos_total,home,total_pos,delta_pos,new_pos,discharged,deaths,case_diag,case_screen,total,swabs,ct,notes) = line.split(',')
-				if datetime == 'data':
-					continue
-				
-				date = datetime[0:4] + datetime[5:7] + datetime[8:10]
-				self.italy_tests.append(int(swabs))
-				self.italy_cases.append(int(total))
-				self.italy_deaths.append(int(deaths))
-	
-		# Verify most recent dates match between US/Italy
-		if not date == self.date:
-			print('ERROR - US and Italy data not consistent: Italy=', date, 'vs US=', self.date)
-			exit(1)
+		try:
+			arrays = datacache.load('italy-data', [italy_data], self.parse_italy_data)
+		except (OSError, ValueError) as e:
+			print('WARNING - unable to load Italy data:', e)
+			self.italy = TimeSeriesStore(self.dates, ['ITA'], ITALY_METRICS)
+			return
+		self.italy = self.align_italy_store(self.build_italy_store(arrays))
+
+	# Parse the Italy data file and return arrays of dates, tests, cases and deaths.
+	def parse_italy_data(self):
+		data = read_csv_columns(italy_data, ['data', 'tamponi', 'totale_casi', 'deceduti'],
+				ITALY_FIELDS, ['data', 'totale_casi'], 'Italy')
+		return {
+			# yyyy-mm-ddThh:mm:ss -> yyyymmdd
+			'dates': numpy.array([d[0:4] + d[5:7] + d[8:10] for d in data['data']], dtype=str),
+			'tests': numpy.array(to_ints(data['tamponi']), dtype=numpy.int64),
+			'cases': numpy.array(to_ints(data['totale_casi']), dtype=numpy.int64),
+			'deaths': numpy.array(to_ints(data['deceduti']), dtype=numpy.int64),
+		}
+
+	# Build a date-indexed store from the parsed Italy |arrays|, including the
+	# hypothetical lead-in data before the first date.
+	def build_italy_store(self, arrays):
+		dates = arrays['dates'].tolist()
+		values = numpy.stack([arrays[m] for m in ITALY_METRICS], axis=1)
+		if len(dates) != 0:
+			first = datetime.datetime.strptime(min(dates), '%Y%m%d')
+			num_lead_in = len(ITALY_LEAD_IN)
+			lead_in = [(first - datetime.timedelta(days=num_lead_in - i)).strftime('%Y%m%d')
+					for i in range(0, num_lead_in)]
+			dates = lead_in + dates
+			values = numpy.concatenate([numpy.array(ITALY_LEAD_IN, dtype=values.dtype), values])
+		store = TimeSeriesStore(sorted(set(dates)), ['ITA'], ITALY_METRICS)
+		store.set_rows(dates, ['ITA'] * len(dates), values)
+		return store
+
+	# Return a copy of the Italy store with the same dates as the US data.
+	# Dates before the Italy data starts or after it ends are missing. Gaps in
+	# the Italy data are filled with the values from the previous day (since
+	# the values are running totals) and reported.
+	def align_italy_store(self, italy):
+		aligned = TimeSeriesStore(self.dates, italy.regions, italy.metrics)
+		if italy.num_dates() == 0:
+			print('WARNING - no Italy data')
+			return aligned
+
+		us_dates = numpy.array(self.dates, dtype=str)
+		italy_dates = numpy.array(italy.dates, dtype=str)
+		# Index of the most recent Italy date on or before each US date.
+		index = numpy.searchsorted(italy_dates, us_dates, side='right') - 1
+		valid = (index >= 0) & (us_dates <= italy_dates[-1])
+		aligned.values[valid] = italy.values[index[valid]]
+		aligned.missing[valid] = italy.missing[index[valid]]
+
+		gaps = us_dates[valid][italy_dates[index[valid]] != us_dates[valid]]
+		if len(gaps) != 0:
+			print('WARNING - missing Italy data for', ','.join(gaps), '- using previous day')
+		if italy.last_date() < self.date:
+			print('WARNING - Italy data ends on', italy.last_date(), 'but US data ends on', self.date)
+		return aligned
 
 # Calc doubling rate, averaged over the past 3 days.
 def calc_doubling_rate(values):
@@ -467,6 +592,29 @@ def ASSERT(expected, actual, info=''):
 def run_tests():
 	data = [4, 8, 16, 32]
 	ASSERT(1.0, calc_doubling_rate(data), data)
+	ASSERT(1.0, growth.calc_doubling_times(data)[-1], data)
+
+	data = [3, 5, 9, 14, 30, 41]
+	doubling = growth.calc_doubling_times(numpy.array([data, data]).T)
+	for i in range(3, len(data)):
+		ASSERT(calc_doubling_rate(data[:i+1]), doubling[i][1], data[:i+1])
+
+	# Zero and missing values have no doubling time.
+	doubling = growth.calc_doubling_times([0, 1, 2, 4, 8])
+	ASSERT(True, math.isnan(doubling[3]), doubling)
+	ASSERT(1.0, doubling[4], doubling)
+
+	increase = growth.calc_increments(growth.to_float([1, 3, 6, 10], [False, False, True, False]))
+	ASSERT(2, increase[1], increase)
+	ASSERT(True, math.isnan(increase[2]) and math.isnan(increase[3]), increase)
+	average = growth.calc_rolling_average([1, 2, 3, numpy.nan, 5, 6, 7, 8, 9], 3)
+	ASSERT(1.5, average[1], average)
+	ASSERT(2.5, average[3], average)
+	ASSERT(8, average[8], average)
+	factors = growth.calc_growth_factors([numpy.nan, 0, 2, 4, 2])
+	ASSERT(True, math.isnan(factors[2]), factors)
+	ASSERT(2, factors[3], factors)
+	ASSERT(0.5, factors[4], factors)
 	
 if __name__ == "__main__":
 	run_tests()
@@ -0,0 +1,85 @@
+from __future__ import division
+
+import csv
+import operator
+
+# Read the requested |columns| from a CSV file in a single pass.
+#
+# Columns are located by name using the header row, so upstream files can
+# reorder or add columns without breaking the loader. If |known_fields| is
+# given, any difference between it and the actual header is reported as a
+# warning.
+#
+# Returns a dict mapping each column name to a list of string values (one per
+# data row). Requested columns that are not present in the file are reported
+# and filled with '' so that callers can apply their usual defaults. Columns in
+# |required| must be present.
+def read_csv_columns(filename, columns, known_fields=None, required=(), label='', encoding=None):
+	with open(filename, newline='', encoding=encoding) as fp:
+		return parse_csv_columns(fp, columns, known_fields, required, label)
+
+# Same as |read_csv_columns|, but reads from |lines| (an open file or a list of
+# lines, starting with the header).
+def parse_csv_columns(lines, columns, known_fields=None, required=(), label=''):
+	reader = csv.reader(lines)
+	header = next(reader)
+	if known_fields:
+		check_schema(header, known_fields, label)
+
+	index = {}
+	for i in range(0, len(header)):
+		index[header[i]] = i
+
+	present = []
+	for c in columns:
+		if c in index:
+			present.append(c)
+		elif c in required:
+			raise ValueError('Missing required column in %s data: %s' % (label, c))
+		else:
+			print('WARNING - missing column in %s data:' % label, c)
+
+	data = {}
+	for c in columns:
+		data[c] = []
+	if len(present) == 0:
+		return data
+
+	cols = [data[c] for c in present]
+	getter = operator.itemgetter(*[index[c] for c in present])
+	num_fields = max([index[c] for c in present]) + 1
+	num_rows = 0
+	for row in reader:
+		if len(row) == 0:
+			continue
+		if len(row) < num_fields:
+			row = row + [''] * (num_fields - len(row))
+		values = getter(row)
+		if len(present) == 1:
+			values = (values,)
+		for i in range(0, len(values)):
+			cols[i].append(values[i])
+		num_rows += 1
+
+	for c in columns:
+		if not c in index:
+			data[c] = [''] * num_rows
+	return data
+
+# Report differences between the expected |known_fields| and the |header| that
+# was found in the file.
+def check_schema(header, known_fields, label):
+	if header == known_fields:
+		return
+	added = [f for f in header if not f in known_fields]
+	removed = [f for f in known_fields if not f in header]
+	if added:
+		print('WARNING - new fields in %s data:' % label, ','.join(added))
+	if removed:
+		print('WARNING - removed fields in %s data:' % label, ','.join(removed))
+	if not added and not removed:
+		print('WARNING - reordered fields in %s data' % label)
+
+# Convert a list of strings to ints, using |default| for blank values.
+def to_ints(values, default=0):
+	return [int(v) if v else default for v in values]
@@ -0,0 +1,219 @@
+from __future__ import division
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+# Persistent cache of parsed input data.
+#
+# Each cache entry is a directory under |cache_dir| containing one .npy file per
+# array and a meta.json file that records the source files (size, mtime and
+# content hash) that the arrays were built from. Arrays are loaded memory-mapped
+# so that a cache hit costs little more than opening the files.
+#
+# An entry is rebuilt automatically whenever one of its source files changes.
+# The mtime/size are checked first, and the content hash is only recomputed
+# when those differ (so that touching a file doesn't force a rebuild).
+
+cache_dir = '.cache'
+
+# Set to False to always parse the source files.
+enabled = True
+
+# Return the arrays for cache entry |name|, building them with |build| if the
+# entry is missing or stale.
+# |sources| is the list of files that the data is derived from.
+# |build| is a function that returns a dict of name -> numpy array.
+# |version| should be incremented when the format of the arrays changes.
+def load(name, sources, build, version=1):
+	if not enabled:
+		return build()
+
+	entry_dir = os.path.join(cache_dir, name)
+	meta_file = os.path.join(entry_dir, 'meta.json')
+	meta = read_meta(meta_file)
+	if meta and meta['version'] == version:
+		source_info = check_sources(meta['sources'], sources)
+		if source_info:
+			arrays = read_arrays(entry_dir, meta['arrays'])
+			if arrays != None:
+				if source_info != meta['sources']:
+					# Content is unchanged, but update the mtime/size.
+					meta['sources'] = source_info
+					write_meta(meta_file, meta)
+				return arrays
+
+	arrays = build()
+	write_entry(entry_dir, version, sources, arrays)
+	return arrays
+
+# Same as |load|, but for a single |source| file that only gains new rows over
+# time. |order| is 'append' if new rows are added at the end of the file (oldest
+# first) or 'prepend' if they are added right after the header (newest first).
+#
+# If the rows that were previously cached are unchanged, |update| is called with
+# the cached arrays and a list of lines (the header followed by only the new
+# rows). It returns the updated arrays, or None if the new rows cannot be merged
+# incrementally (for example, if they contain data for dates that were already
+# cached). In that case, or if any historical rows have changed, all the data is
+# rebuilt using |build|.
+def load_appendable(name, source, order, build, update, version=1):
+	if not enabled:
+		return build()
+
+	entry_dir = os.path.join(cache_dir, name)
+	meta_file = os.path.join(entry_dir, 'meta.json')
+	meta = read_meta(meta_file)
+	if meta and meta['version'] == version:
+		source_info = check_sources(meta['sources'], [source])
+		arrays = read_arrays(entry_dir, meta['arrays'])
+		if source_info and arrays != None:
+			if source_info != meta['sources']:
+				meta['sources'] = source_info
+				write_meta(meta_file, meta)
+			return arrays
+		if arrays != None and 'append' in meta:
+			lines = read_new_lines(source, order, meta['append'])
+			if lines != None:
+				print('Updating cached', name, 'data with', len(lines) - 1, 'new rows')
+				arrays = update(arrays, lines)
+				if arrays != None:
+					write_entry(entry_dir, version, [source], arrays, order)
+					return arrays
+			print('Existing rows changed in', source, '- rebuilding cached', name, 'data')
+
+	arrays = build()
+	write_entry(entry_dir, version, [source], arrays, order)
+	return arrays
+
+# Return the header line and the lines that have been added to |source| since
+# the cached |info| was recorded. Returns None if any of the previous content
+# of the file has changed.
+def read_new_lines(source, order, info):
+	with open(source, 'rb') as fp:
+		data = fp.read()
+	header_size = data.find(b'\n') + 1
+	if header_size == 0 or hash_bytes(data[:header_size]) != info['header_hash']:
+		return None
+
+	body_size = info['body_size']
+	if len(data) - header_size < body_size:
+		return None
+	if order == 'append':
+		old = data[header_size:header_size + body_size]
+		new = data[header_size + body_size:]
+		if body_size != 0 and not old.endswith(b'\n'):
+			return None
+	else:
+		old = data[len(data) - body_size:]
+		new = data[header_size:len(data) - body_size]
+		if len(new) != 0 and not new.endswith(b'\n'):
+			return None
+	if hash_bytes(old) != info['body_hash']:
+		return None
+
+	lines = [data[:header_size].decode('utf-8')]
+	lines.extend(new.decode('utf-8').splitlines(True))
+	return lines
+
+# Return the info needed to detect new rows in an appendable |source|.
+def calc_append_info(source):
+	with open(source, 'rb') as fp:
+		data = fp.read()
+	header_size = data.find(b'\n') + 1
+	return {
+		'header_hash': hash_bytes(data[:header_size]),
+		'body_size': len(data) - header_size,
+		'body_hash': hash_bytes(data[header_size:]),
+	}
+
+def read_meta(meta_file):
+	if not os.path.exists(meta_file):
+		return None
+	try:
+		with open(meta_file) as fp:
+			return json.load(fp)
+	except ValueError:
+		return None
+
+def write_meta(meta_file, meta):
+	tmp_file = meta_file + '.tmp'
+	with open(tmp_file, 'w') as fp:
+		json.dump(meta, fp, indent=1, sort_keys=True)
+	os.replace(tmp_file, meta_file)
+
+def read_arrays(entry_dir, names):
+	arrays = {}
+	try:
+		for n in names:
+			arrays[n] = numpy.load(os.path.join(entry_dir, n + '.npy'), mmap_mode='r')
+	except (IOError, ValueError):
+		return None
+	return arrays
+
+# Write a new cache entry. If |order| is given, then the info needed for
+# |load_appendable| is also recorded.
+def write_entry(entry_dir, version, sources, arrays, order=None):
+	# Write into a temp dir and then move it into place since |arrays| may be
+	# memory-mapped from the files in the current entry.
+	tmp_dir = entry_dir + '.tmp'
+	if os.path.exists(tmp_dir):
+		shutil.rmtree(tmp_dir)
+	os.makedirs(tmp_dir)
+	for n in arrays:
+		numpy.save(os.path.join(tmp_dir, n + '.npy'), arrays[n])
+	meta = {
+		'version': version,
+		'sources': calc_source_info(sources),
+		'arrays': sorted(arrays.keys()),
+	}
+	if order:
+		meta['append'] = calc_append_info(sources[0])
+	write_meta(os.path.join(tmp_dir, 'meta.json'), meta)
+
+	if os.path.exists(entry_dir):
+		shutil.rmtree(entry_dir)
+	os.rename(tmp_dir, entry_dir)
+
+# Return the current info for each source file.
+def calc_source_info(sources):
+	info = {}
+	for src in sources:
+		st = os.stat(src)
+		info[src] = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': hash_file(src)}
+	return info
+
+# Return updated source info if all |sources| match the |cached| info, or None
+# if any of them have changed.
+def check_sources(cached, sources):
+	if sorted(cached.keys()) != sorted(sources):
+		return None
+	info = {}
+	for src in sources:
+		if not os.path.exists(src):
+			return None
+		st = os.stat(src)
+		c = cached[src]
+		if st.st_size == c['size'] and st.st_mtime == c['mtime']:
+			info[src] = c
+			continue
+		if st.st_size != c['size']:
+			return None
+		hash = hash_file(src)
+		if hash != c['hash']:
+			return None
+		info[src] = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': hash}
+	return info
+
+def hash_bytes(data):
+	return hashlib.sha1(data).hexdigest()
+
+def hash_file(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as fp:
+		for chunk in iter(lambda: fp.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
@@ -2,7 +2,7 @@
 
 set -e
 
-python plot.py --all
+python build.py --no-maps --jobs $(getconf _NPROCESSORS_ONLN)
 
 git commit -a -m "Generate graphs for $1 $2 $3"
 
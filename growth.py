@@ -0,0 +1,103 @@
+from __future__ import division
+
+import math
+import numpy
+
+# Growth metrics calculated for all regions and all dates at once.
+#
+# Each function takes a series (or a date x region matrix) of cumulative values
+# and operates along the date axis (axis 0). Results are float arrays with the
+# same shape as the input, with NaN for days where the metric is undefined
+# (missing data, not enough history, or a division by zero).
+
+# Weights used to average the doubling time over the past 3 days. The first
+# weight is for the doubling time measured over the past day.
+DOUBLING_WEIGHTS = [0.6, 0.3, 0.1]
+
+# Number of days in the rolling average.
+ROLLING_DAYS = 7
+
+# Return a float copy of |values| with the entries flagged in |missing| set
+# to NaN.
+def to_float(values, missing=None):
+	result = numpy.array(values, dtype=numpy.float64)
+	if missing is not None:
+		result[numpy.asarray(missing)] = numpy.nan
+	return result
+
+# Calc the doubling time (in days) for each day, as a weighted average of the
+# doubling time measured over the past 1, 2 and 3 days.
+# Days with zero or missing values (on the day or in the past 3 days) are NaN.
+# Days with no growth over one of the intervals are inf.
+def calc_doubling_times(values, weights=DOUBLING_WEIGHTS):
+	values = to_float(values)
+	result = numpy.full(values.shape, numpy.nan)
+	num_days = len(weights)
+	if values.shape[0] <= num_days:
+		return result
+
+	ln2 = math.log(2)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		logs = numpy.log(numpy.where(values > 0, values, numpy.nan))
+		ln_curr = logs[num_days:]
+		avg = numpy.zeros(ln_curr.shape)
+		for delta in range(1, num_days + 1):
+			lndata = ln_curr - logs[num_days - delta:len(logs) - delta]
+			avg += weights[delta - 1] * delta * (ln2 / lndata)
+	result[num_days:] = avg
+	return result
+
+# Calc the daily increase for each day.
+# The first day and days where either value is missing are NaN.
+def calc_increments(values):
+	values = to_float(values)
+	result = numpy.full(values.shape, numpy.nan)
+	result[1:] = values[1:] - values[:-1]
+	return result
+
+# Calc the average of |values| over the past |num_days| for each day.
+# Missing values are skipped, so the average is over the days that have data
+# (and the first few days average over less than |num_days|). Days with no
+# data in the window are NaN.
+def calc_rolling_average(values, num_days=ROLLING_DAYS):
+	values = to_float(values)
+	valid = ~numpy.isnan(values)
+	zero = numpy.zeros((1,) + values.shape[1:])
+	sums = numpy.concatenate([zero, numpy.cumsum(numpy.where(valid, values, 0), axis=0)])
+	counts = numpy.concatenate([zero, numpy.cumsum(valid, axis=0)])
+
+	# sum(values[start:i+1]) = sums[i+1] - sums[start]
+	start = numpy.maximum(numpy.arange(1, len(values) + 1) - num_days, 0)
+	total = sums[1:] - sums[start]
+	count = counts[1:] - counts[start]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		return numpy.where(count > 0, total / count, numpy.nan)
+
+# Calc the growth factor (the ratio of each day's increase to the previous
+# day's increase) from the daily |increments|.
+# Days where the previous increase is zero, negative or missing are NaN.
+def calc_growth_factors(increments):
+	increments = to_float(increments)
+	result = numpy.full(increments.shape, numpy.nan)
+	prev = increments[:-1]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		result[1:] = numpy.where(prev > 0, increments[1:] / prev, numpy.nan)
+	return result
+
+# Calc all the growth metrics for the cumulative |values| (a series or a
+# date x region matrix) with optional |missing| flags.
+# Returns a dict with:
+#   doubling - doubling time in days
+#   increase - daily increase
+#   average - rolling average of the daily increase
+#   growth - growth factor of the rolling average
+def calc_growth_metrics(values, missing=None, num_days=ROLLING_DAYS):
+	values = to_float(values, missing)
+	increase = calc_increments(values)
+	average = calc_rolling_average(increase, num_days)
+	return {
+		'doubling': calc_doubling_times(values),
+		'increase': increase,
+		'average': average,
+		'growth': calc_growth_factors(average),
+	}
@@ -0,0 +1,147 @@
+from __future__ import division
+
+import hashlib
+import json
+import numpy
+import os
+
+import datacache
+
+# Build manifest for the generated output files.
+#
+# For each output file, the manifest records a key (a hash of all the inputs
+# and parameters that were used to generate it) and the size/mtime/hash of the
+# file. An output only needs to be rebuilt if its key has changed or if the
+# file has been changed or removed since it was built.
+#
+# The manifest is stored with the other cached data, so it is local to each
+# checkout.
+
+# Set to False to rebuild all outputs.
+enabled = True
+
+_entries = None
+
+# Status of each output checked during this run: True if it was rebuilt,
+# False if it was up to date.
+_status = {}
+
+# Outputs checked since the last call to |take_changes|.
+_changed = set()
+
+def manifest_file():
+	return os.path.join(datacache.cache_dir, 'manifest.json')
+
+def get_entries():
+	global _entries
+	if _entries == None:
+		_entries = datacache.read_meta(manifest_file()) or {}
+	return _entries
+
+def save():
+	if _entries == None:
+		return
+	if not os.path.exists(datacache.cache_dir):
+		os.makedirs(datacache.cache_dir)
+	datacache.write_meta(manifest_file(), _entries)
+
+# Return a key for the given |inputs|, which can be numpy arrays, or strings,
+# numbers, lists and dicts of them.
+def calc_key(*inputs):
+	h = hashlib.sha1()
+	for i in inputs:
+		if isinstance(i, numpy.ndarray):
+			h.update(('%s%s' % (i.dtype, i.shape)).encode('utf-8'))
+			h.update(numpy.ascontiguousarray(i).tobytes())
+		elif isinstance(i, str):
+			h.update(i.encode('utf-8'))
+		else:
+			h.update(json.dumps(i, sort_keys=True, default=str).encode('utf-8'))
+		h.update(b'\n')
+	return h.hexdigest()
+
+# Return a key for the source code in |files| (so that outputs are rebuilt when
+# the code that generates them changes).
+def calc_code_key(files):
+	return calc_key([datacache.hash_file(f) for f in files])
+
+# Return True if all the |outputs| were built with |key| and haven't changed
+# since then. Up to date outputs are included in the |report|.
+def is_current(outputs, key):
+	if not enabled:
+		return False
+	entries = get_entries()
+	for output in outputs:
+		entry = entries.get(output)
+		if not entry or entry['key'] != key:
+			return False
+		if not datacache.check_sources({output: entry['file']}, [output]):
+			return False
+	for output in outputs:
+		_status[output] = False
+		_changed.add(output)
+	return True
+
+# Record that the |outputs| have been built with |key|.
+def record(outputs, key):
+	entries = get_entries()
+	info = datacache.calc_source_info(outputs)
+	for output in outputs:
+		entries[output] = {'key': key, 'file': info[output]}
+		_status[output] = True
+		_changed.add(output)
+
+# Return the entries and status of the outputs that have been checked since the
+# last call. This is used to pass the changes made in a forked process back to
+# the main process (see |merge_changes|).
+def take_changes():
+	global _changed
+	entries = get_entries()
+	changes = {}
+	for output in _changed:
+		changes[output] = [entries.get(output), _status[output]]
+	_changed = set()
+	return changes
+
+# Add the |changes| returned by |take_changes| (in another process).
+def merge_changes(changes):
+	entries = get_entries()
+	for output in changes:
+		(entry, status) = changes[output]
+		if entry:
+			entries[output] = entry
+		_status[output] = status
+
+# Return True if |output| was rebuilt during this run.
+def was_rebuilt(output):
+	return _status.get(output, False)
+
+# Write |text| to |filename|, unless the file already contains it.
+def write_text(filename, text):
+	key = calc_key(text)
+	if is_current([filename], key):
+		return
+	with open(filename, 'w') as fp:
+		fp.write(text)
+	record([filename], key)
+
+# Print a summary of the outputs that were rebuilt (by top-level directory)
+# and save the manifest.
+def report():
+	rebuilt = {}
+	current = {}
+	for output in _status:
+		dir = output.split('/')[0]
+		if not '/' in output:
+			dir = '.'
+		rebuilt.setdefault(dir, 0)
+		current.setdefault(dir, 0)
+		if _status[output]:
+			rebuilt[dir] += 1
+		else:
+			current[dir] += 1
+	print('Rebuilt', sum(rebuilt.values()), 'of', len(_status), 'outputs')
+	for dir in sorted(rebuilt):
+		if rebuilt[dir] != 0:
+			print('  %s: %d rebuilt, %d up to date' % (dir, rebuilt[dir], current[dir]))
+	save()
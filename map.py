@@ -2,7 +2,9 @@ from __future__ import division
 
 import colorsys
 import getopt
+import io
 import math
+import numpy
 import operator
 import os
 import re
@@ -10,6 +12,12 @@ import shutil
 import subprocess
 import sys
 
+import datacache
+import manifest
+from csvdata import parse_csv_columns
+from csvdata import to_ints
+from timeseries import TimeSeriesStore
+from timeseries import store_from_arrays
 from usinfo import USInfo
 
 census_data = 'data/census/DEC_10_SF1_GCTPH1.US05PR/DEC_10_SF1_GCTPH1.US05PR.csv'
@@ -24,17 +32,54 @@ us_map_deaths_rel = 'us-deaths-rel.svg'
 FIPS_NEW_YORK_CITY = '36998'
 FIPS_KANSAS_CITY_MO = '29998'
 
-AREA_SCALE = 1000000
+# Known fields in the NYT county data.
+NYT_FIELDS = ['date', 'county', 'state', 'fips', 'cases', 'deaths']
 
-# Max values per N square miles.
-#MAX_CASES_PNSM = 111574425.9
-#MAX_DEATHS_PNSM = 2564017.8
-# 18 Apr 2020
-MAX_CASES_PNSM = 420789692
-MAX_DEATHS_PNSM = 28521395
+NYT_METRICS = ['cases', 'deaths']
 
-# True to calculate the max PNSM values, otherwise use values above.
-CALCULATE_MAX_PNSM = False
+AREA_SCALE = 1000000
+
+# Number of colors in each color ramp. The scaled values (0.0 - 1.0) are
+# rounded to the nearest step.
+COLOR_STEPS = 256
+
+# Step (in log10) that the legend scale of the fixed maps is rounded up to, so
+# that the scale only changes every few weeks rather than every day.
+FIXED_SCALE_STEP = 0.1
+
+# An SVG map file split into chunks so that maps can be generated without
+# re-reading and scanning the file for each map.
+# Each chunk is static text, a '%%TAG%%' placeholder or None for the
+# '#INSERT_STYLES' line (which is replaced by the CSS styles for the map).
+class SvgTemplate:
+	def __init__(self, filename):
+		self.chunks = []
+		text = []
+		with open(filename) as fp:
+			for line in fp:
+				if line.startswith('  #INSERT_STYLES'):
+					self.add_text(''.join(text))
+					text = []
+					self.chunks.append(None)
+				else:
+					text.append(line)
+		self.add_text(''.join(text))
+
+	def add_text(self, text):
+		for chunk in re.split(r'(%%[A-Z0-9]+%%)', text):
+			if chunk != '':
+				self.chunks.append(chunk)
+
+	# Return the SVG with each of the |tags| replaced with its value and
+	# |styles| inserted. Tags that are not in |tags| are left unchanged.
+	def generate(self, tags, styles):
+		output = []
+		for chunk in self.chunks:
+			if chunk == None:
+				output.append(styles)
+			else:
+				output.append(tags.get(chunk, chunk))
+		return ''.join(output)
 
 class MapData:
 	def __init__(self, fixed):
@@ -54,6 +99,15 @@ class MapData:
 		
 		self.use_fixed_max_pnsm = fixed
 
+		# Parsed SVG map templates, by filename.
+		self.svg_templates = {}
+
+		# Precomputed colors for the absolute and relative (to US avg) maps.
+		self.color_ramps = {
+			False: self.calc_color_ramp(False),
+			True: self.calc_color_ramp(True),
+		}
+
 	def load_census(self):
 		self.names = {}
 		self.area = {}
@@ -65,60 +119,42 @@ class MapData:
 		self.us_area = 0
 		
 		# Load data for states and Puerto Rico.
-		with open(census_data, encoding = "ISO-8859-1") as fp:
-			for line in fp:
-				#  0: GEO.id - geo id, e.g., "0100000US"
-				#  1: GEO.id2 - geo id, part 2, e.g., ""
-				#  2: GEO.display-label geo label, e.g., "United States"
-				#  3: GCT_STUB.target-geo-id - long fips id, e.g., "0500000US01001"
-				#  4: GCT_STUB.target-geo-id2 - fips id, e.g., "01001"
-				#  5: GCT_STUB.display-label - long label, e.g., "United States - Alabama - Autauga County"
-				#  6: GCT_STUB.display-label - label, e.g., "Autauga County"
-				#  7: HD01 - Population
-				#  8: HD02 - Housing units
-				#  9: SUBHD0301 - Area in square miles - Total
-				# 10: SUBHD0302 - Area in square miles - Water
-				# 11: SUBHD0303 - Area in square miles - Land
-				# 12: SUBHD0401 - Density per square mile of land area - Population
-				# 13: SUBHD0402 - Density per square mile of land area - Housing units
-				data = line.strip().split(',')
-				if data[0] == 'GEO.id':
-					continue
-				fips = data[4]
-				full_label = data[5]
-				state = full_label.split(' - ')[1] if '-' in full_label else ''
-				label = data[6]
-				area = float(data[11])  # Land area
-				pop_density = float(data[12])
-				
-				if fips == '':
-					if not label == 'United States':
-						print('ERROR: Blank fips for', label, ' fips=', fips)
-					continue
+		census = datacache.load('census', [census_data], self.parse_census)
+		for i in range(0, len(census['fips'])):
+			fips = str(census['fips'][i])
+			state = str(census['state'][i])
+			label = str(census['label'][i])
+			area = float(census['area'][i])  # Land area
+			pop_density = float(census['density'][i])
+			
+			if fips == '':
+				if not label == 'United States':
+					print('ERROR: Blank fips for', label, ' fips=', fips)
+				continue
 
-				# Handle states.
-				if len(fips) == 2:
-					fips += '999'
-					self.state2fips[label] = fips
-					self.fips2state[fips] = label
-					self.state_fips_list[fips] = []
-				else:
-					# Gather a list of all fips within each state
-					state_fips = fips[0:2] + '999'
-					self.state_fips_list[state_fips].append(fips)
+			# Handle states.
+			if len(fips) == 2:
+				fips += '999'
+				self.state2fips[label] = fips
+				self.fips2state[fips] = label
+				self.state_fips_list[fips] = []
+			else:
+				# Gather a list of all fips within each state
+				state_fips = fips[0:2] + '999'
+				self.state_fips_list[state_fips].append(fips)
 
-					self.us_area += area
+				self.us_area += area
 
-				# Update fips id for regions that have changed.
-				for f in self.updated_fips:
-					if fips == f[0]:
-						fips = f[1]
-						print('Updating fips from', f[0], 'to', f[1], 'for', label, state)
-				
-				self.names[fips] = label
-				self.area[fips] = area
-				self.density[fips] = pop_density
-						
+			# Update fips id for regions that have changed.
+			for f in self.updated_fips:
+				if fips == f[0]:
+					fips = f[1]
+					print('Updating fips from', f[0], 'to', f[1], 'for', label, state)
+			
+			self.names[fips] = label
+			self.area[fips] = area
+			self.density[fips] = pop_density
+					
 		# Special FIPS for NYT data
 		self.names[FIPS_NEW_YORK_CITY] = 'New York City'  # NY
 		self.area[FIPS_NEW_YORK_CITY] = 0
@@ -135,11 +171,62 @@ class MapData:
 		self.add_state('66999', 'Guam', 212)
 		self.add_state('69999', 'Northern Mariana Islands', 184.2)
 		self.add_state('78999', 'Virgin Islands', 133.7)
+
+		# Index of the regions in each state (by 2-digit state fips), including
+		# the state itself and the special NYC/Kansas City regions, so that the
+		# maps for a state don't need to scan all the regions.
+		self.state_regions = {}
+		for fips in self.names:
+			state_fips = fips[0:2]
+			if not state_fips in self.state_regions:
+				self.state_regions[state_fips] = []
+			self.state_regions[state_fips].append(fips)
 				
 		#print self.names['53061'], self.area['53061']
 		#print self.density['53061']
 		#print self.names['36998'], self.area['36998']
 		
+	# Parse the census data and return arrays with the fips, state, label, land
+	# area and population density for each region.
+	def parse_census(self):
+		fips_list = []
+		states = []
+		labels = []
+		areas = []
+		densities = []
+		with open(census_data, encoding = "ISO-8859-1") as fp:
+			for line in fp:
+				#  0: GEO.id - geo id, e.g., "0100000US"
+				#  1: GEO.id2 - geo id, part 2, e.g., ""
+				#  2: GEO.display-label geo label, e.g., "United States"
+				#  3: GCT_STUB.target-geo-id - long fips id, e.g., "0500000US01001"
+				#  4: GCT_STUB.target-geo-id2 - fips id, e.g., "01001"
+				#  5: GCT_STUB.display-label - long label, e.g., "United States - Alabama - Autauga County"
+				#  6: GCT_STUB.display-label - label, e.g., "Autauga County"
+				#  7: HD01 - Population
+				#  8: HD02 - Housing units
+				#  9: SUBHD0301 - Area in square miles - Total
+				# 10: SUBHD0302 - Area in square miles - Water
+				# 11: SUBHD0303 - Area in square miles - Land
+				# 12: SUBHD0401 - Density per square mile of land area - Population
+				# 13: SUBHD0402 - Density per square mile of land area - Housing units
+				data = line.strip().split(',')
+				if data[0] == 'GEO.id':
+					continue
+				full_label = data[5]
+				fips_list.append(data[4])
+				states.append(full_label.split(' - ')[1] if '-' in full_label else '')
+				labels.append(data[6])
+				areas.append(float(data[11]))
+				densities.append(float(data[12]))
+		return {
+			'fips': numpy.array(fips_list, dtype=str),
+			'state': numpy.array(states, dtype=str),
+			'label': numpy.array(labels, dtype=str),
+			'area': numpy.array(areas),
+			'density': numpy.array(densities),
+		}
+
 	def add_state(self, fips, name, area):
 		self.names[fips] = name
 		self.area[fips] = area
@@ -147,108 +234,100 @@ class MapData:
 		self.fips2state[fips] = name
 	
 	def load_nyt(self, process_date):
-		self.curr_date = ''
-		found_date = False
-		
+		self.load_nyt_data()
+		self.set_nyt_date(process_date)
+
+		print('Max cases psm', self.max_cases_per_Nsqmi)
+		print('Max deaths psm', self.max_deaths_per_Nsqmi)
+		print('US total: cases', self.us_cases, 'deaths', self.us_deaths)
+		print('US avg cases psm', self.us_cases_per_Nsqmi)
+		print('US avg deaths psm', self.us_deaths_per_Nsqmi)
+
+	# Load the NYT county data as a date x region store of cases and deaths.
+	# Regions are fips codes, or 'county|state' for rows without a fips (other
+	# than NYC and Kansas City, which are given special fips codes).
+	def load_nyt_data(self):
+		# New dates are added to the end of the NYT data file.
+		nyt = datacache.load_appendable('nyt', nyt_data, 'append', self.parse_nyt, self.update_nyt, 2)
+		self.nyt = store_from_arrays(nyt)
+
+	# Calculate the map data for |process_date| ('yyyy-mm-dd'), or for the
+	# most recent date in the NYT data.
+	def set_nyt_date(self, process_date):
+		if process_date:
+			if not process_date in self.nyt.date_index:
+				print('ERROR: Unable to find data for', process_date)
+				exit(1)
+			date = process_date
+		else:
+			date = self.nyt.last_date()
+		self.curr_date = date
+		d = self.nyt.date_index[date]
+		cases_data = self.nyt.values[d, :, self.nyt.metric_index['cases']].tolist()
+		deaths_data = self.nyt.values[d, :, self.nyt.metric_index['deaths']].tolist()
+		present = ~self.nyt.missing[d, :, 0]
+
+		self.cases = {}
+		self.deaths = {}
+		self.max_cases_per_Nsqmi = 0
+		self.max_deaths_per_Nsqmi = 0
 		self.us_cases = 0
 		self.us_deaths = 0
-		
-		with open(nyt_data) as fp:
-			for line in fp:
-				# 0: date - "2020-01-21"
-				# 1: county - "Snohomish"
-				# 2: state - "Washington"
-				# 3: fips - "53061"
-				# 4: cases
-				# 5: deaths 
-				data = line.strip().split(',')
-				if data[0] == 'date':
-					continue
-				date = data[0]
-				county = data[1]
-				state = data[2]
-				fips = data[3]
-				cases = int(data[4])
-				deaths = int(data[5])
-				
-				if date != self.curr_date:
-					# If finished processing the request date, then skip
-					if process_date and self.curr_date == process_date:
-						continue
-					
-					# Reset all data
-					self.cases = {}
-					self.deaths = {}
-					self.max_cases_per_Nsqmi = 0
-					self.max_deaths_per_Nsqmi = 0
-					self.us_cases = 0
-					self.us_deaths = 0
-
-					unknown_state_cases = {}
-					unknown_state_deaths = {}
-					state_fips_with_cases = {}
-					state_fips_with_deaths = {}
-					
-					# Initialize data for regions that require special handling.
-					for fips in self.nyc_fips + self.kc_fips:
-						self.cases[fips] = 0
-						self.deaths[fips] = 0
 
-					self.curr_date = date
-					if date == process_date:
-						found_date = True
+		unknown_state_cases = {}
+		unknown_state_deaths = {}
+		state_fips_with_cases = {}
+		state_fips_with_deaths = {}
 
-				if process_date and date != process_date:
-					continue
-									
-				if fips == '' and county == 'New York City':
-					fips = FIPS_NEW_YORK_CITY
+		# Initialize data for regions that require special handling.
+		for fips in self.nyc_fips + self.kc_fips:
+			self.cases[fips] = 0
+			self.deaths[fips] = 0
 
-				if fips == '' and county == 'Kansas City' and state == 'Missouri':
-					fips = FIPS_KANSAS_CITY_MO
-					
-				if fips in self.nyc_fips:
-					print('ERROR: data for NYC in', fips)
-				
-				if fips == '':
-					if state in self.state2fips:
-						if cases != 0:
-							unknown_state_cases[self.state2fips[state]] = cases
-						if deaths != 0:
-							unknown_state_deaths[self.state2fips[state]] = deaths
-					else:
-						print('ERROR: Blank fips:', line.strip())
-					continue
+		for r in numpy.flatnonzero(present).tolist():
+			fips = self.nyt.regions[r]
+			cases = cases_data[r]
+			deaths = deaths_data[r]
 
-				if not fips in self.names:
-					print('Unknown fips:', line.strip())
-					continue
+			if fips in self.nyc_fips:
+				print('ERROR: data for NYC in', fips)
+
+			if '|' in fips:
+				(county, state) = fips.split('|')
+				if state in self.state2fips:
+					if cases != 0:
+						unknown_state_cases[self.state2fips[state]] = cases
+					if deaths != 0:
+						unknown_state_deaths[self.state2fips[state]] = deaths
+				else:
+					print('ERROR: Blank fips:', ','.join([date, county, state, '', str(cases), str(deaths)]))
+				continue
 
-				self.cases[fips] = cases
-				self.deaths[fips] = deaths
-				self.us_cases += cases
-				self.us_deaths += deaths
-				
-				# Accumulate counties with data for each state. This is used to
-				# distribute unknown cases to these counties. Note that unknown
-				# values are not distributed to counties that report 0.
-				state_fips = fips[0:2] + '999'
-				if cases != 0:
-					if not state_fips in state_fips_with_cases:
-						state_fips_with_cases[state_fips] = []
-					state_fips_with_cases[state_fips].append(fips)
-				if deaths != 0:
-					if not state_fips in state_fips_with_deaths:
-						state_fips_with_deaths[state_fips] = []
-					state_fips_with_deaths[state_fips].append(fips)
-				
-				# Keep track of max value so that we can normalize data to that value.
-				self.update_max_per_Nsqmi(cases, deaths, fips)
+			if not fips in self.names:
+				print('Unknown fips:', ','.join([date, fips, str(cases), str(deaths)]))
+				continue
 
-		if process_date and not found_date:
-			print('ERROR: Unable to find data for', process_date)
-			exit(1)
+			self.cases[fips] = cases
+			self.deaths[fips] = deaths
+			self.us_cases += cases
+			self.us_deaths += deaths
+			
+			# Accumulate counties with data for each state. This is used to
+			# distribute unknown cases to these counties. Note that unknown
+			# values are not distributed to counties that report 0.
+			state_fips = fips[0:2] + '999'
+			if cases != 0:
+				if not state_fips in state_fips_with_cases:
+					state_fips_with_cases[state_fips] = []
+				state_fips_with_cases[state_fips].append(fips)
+			if deaths != 0:
+				if not state_fips in state_fips_with_deaths:
+					state_fips_with_deaths[state_fips] = []
+				state_fips_with_deaths[state_fips].append(fips)
 			
+			# Keep track of max value so that we can normalize data to that value.
+			self.update_max_per_Nsqmi(cases, deaths, fips)
+
 		# Equally distribute the data amongst the 5 boroughs based on size (sq mi)
 		for fips in self.nyc_fips:
 			percent = self.area[fips] / self.area[FIPS_NEW_YORK_CITY]
@@ -320,25 +399,58 @@ class MapData:
 				self.deaths[fips] += unknown_state_deaths[state_fips] * (self.area[fips] / area)
 				self.update_max_per_Nsqmi(0, self.deaths[fips], fips)			
 
-		# Overwrite calculated max per square mile values so that we use the same
-		# value when plotting historical graphs.
-		if self.use_fixed_max_pnsm:
-			print('Using specified max values')
-			self.max_cases_per_Nsqmi = MAX_CASES_PNSM
-			self.max_deaths_per_Nsqmi = MAX_DEATHS_PNSM
-		else:
-			print('Using calculated max values')
-		print('Max cases psm', self.max_cases_per_Nsqmi)
-		print('Max deaths psm', self.max_deaths_per_Nsqmi)
-		
 		#print fips, self.names['53061'], self.cases['53061'], self.deaths['53061']
 
-		print('US total: cases', self.us_cases, 'deaths', self.us_deaths)
 		self.us_cases_per_Nsqmi = self.us_cases * AREA_SCALE / self.us_area
 		self.us_deaths_per_Nsqmi = self.us_deaths * AREA_SCALE / self.us_area
-		print('US avg cases psm', self.us_cases_per_Nsqmi)
-		print('US avg deaths psm', self.us_deaths_per_Nsqmi)
-		
+
+	# Parse the NYT county data and return the arrays for the store.
+	def parse_nyt(self):
+		with open(nyt_data, newline='') as fp:
+			return self.parse_nyt_lines(fp).to_arrays()
+
+	# Add the new rows in |lines| to the cached NYT data |arrays|.
+	# Returns None if the new rows include dates that have already been loaded.
+	def update_nyt(self, arrays, lines):
+		old = store_from_arrays(arrays)
+		new = self.parse_nyt_lines(lines)
+		if new.num_dates() == 0 or new.dates[0] <= old.last_date():
+			return None
+
+		regions = old.regions + [r for r in new.regions if not r in old.region_index]
+		store = TimeSeriesStore(old.dates + new.dates, regions, NYT_METRICS)
+		num_old_dates = old.num_dates()
+		num_old_regions = len(old.regions)
+		store.values[:num_old_dates, :num_old_regions] = old.values
+		store.missing[:num_old_dates, :num_old_regions] = old.missing
+		new_regions = [store.region_index[r] for r in new.regions]
+		store.values[num_old_dates:, new_regions] = new.values
+		store.missing[num_old_dates:, new_regions] = new.missing
+		return store.to_arrays()
+
+	# Parse the NYT data in |lines| (starting with the header) into a store.
+	# Regions are added in the order that they first appear in the data.
+	def parse_nyt_lines(self, lines):
+		data = parse_csv_columns(lines, NYT_FIELDS, NYT_FIELDS, NYT_FIELDS, 'NYT')
+		regions = []
+		for i in range(0, len(data['date'])):
+			regions.append(self.calc_nyt_region(data['fips'][i], data['county'][i], data['state'][i]))
+
+		store = TimeSeriesStore(sorted(set(data['date'])), list(dict.fromkeys(regions)), NYT_METRICS)
+		values = numpy.array([to_ints(data['cases']), to_ints(data['deaths'])], dtype=numpy.int64).T
+		store.set_rows(data['date'], regions, values.reshape(-1, len(NYT_METRICS)))
+		return store
+
+	# Return the region for a row of NYT data.
+	def calc_nyt_region(self, fips, county, state):
+		if fips != '':
+			return fips
+		if county == 'New York City':
+			return FIPS_NEW_YORK_CITY
+		if county == 'Kansas City' and state == 'Missouri':
+			return FIPS_KANSAS_CITY_MO
+		return '%s|%s' % (county, state)
+
 	def update_max_per_Nsqmi(self, cases, deaths, fips):
 		cases_per_Nsqmi = cases * AREA_SCALE / self.area[fips]
 		if cases_per_Nsqmi > self.max_cases_per_Nsqmi:
@@ -431,15 +543,73 @@ class MapData:
 
 			tags['%%TITLE%%'] = 'COVID-19 Reported %s' % type
 			
-		with open(map) as fpin:
-			with open(output, 'w') as fpout:
-				for line in fpin:
-					if line.startswith('  #INSERT_STYLES'):
-						self.write_css_styles('all', fpout, data, val_log_max, us_avg_log, relative)
-					else:
-						line = self.replace_tags(line, tags)
-						fpout.write(line)
+		styles = io.StringIO()
+		self.write_css_styles('all', styles, data, val_log_max, us_avg_log, relative)
+		manifest.write_text(output, self.get_svg_template(map).generate(tags, styles.getvalue()))
 	
+	# Generate the US maps with a fixed legend (for the animations) for each
+	# date from |start_date| (or from the first date if blank) up to the current
+	# date. All the maps use the same legend scale, which covers the max values
+	# over all the dates up to the current date. The scale is stored so that it
+	# only changes (and all the maps are regenerated) when the max values grow
+	# past it.
+	def generate_fixed_maps(self, start_date):
+		end_date = self.curr_date
+		dates = [d for d in self.nyt.dates if d <= end_date]
+
+		max_cases_per_Nsqmi = 0
+		max_deaths_per_Nsqmi = 0
+		for d in dates:
+			self.set_nyt_date(d)
+			max_cases_per_Nsqmi = max(max_cases_per_Nsqmi, self.max_cases_per_Nsqmi)
+			max_deaths_per_Nsqmi = max(max_deaths_per_Nsqmi, self.max_deaths_per_Nsqmi)
+		print('Max cases psm for all dates', max_cases_per_Nsqmi)
+		print('Max deaths psm for all dates', max_deaths_per_Nsqmi)
+
+		scale_file = os.path.join(datacache.cache_dir, 'fixed-maps.json')
+		scale = datacache.read_meta(scale_file)
+		if (not scale or scale.get('cases', 0) < max_cases_per_Nsqmi
+				or scale.get('deaths', 0) < max_deaths_per_Nsqmi):
+			scale = {
+				'cases': self.calc_fixed_scale(max_cases_per_Nsqmi),
+				'deaths': self.calc_fixed_scale(max_deaths_per_Nsqmi),
+			}
+			if start_date > dates[0]:
+				print('Legend scale has changed, generating fixed maps from', dates[0], 'instead of', start_date)
+			start_date = dates[0]
+
+			# Maps after the current date are not regenerated here.
+			ymd = end_date[0:4] + end_date[5:7] + end_date[8:10]
+			for name in [us_map_cases, us_map_cases_rel, us_map_deaths, us_map_deaths_rel]:
+				name = name.split('.')[0]
+				dir = 'map-%s' % name
+				if not os.path.exists(dir):
+					continue
+				later = [f for f in os.listdir(dir) if f.endswith('.svg') and f > '%s-%s.svg' % (name, ymd)]
+				if later:
+					print('WARNING - %d maps in %s are after %s and use a different scale' % (len(later), dir, end_date))
+		print('Legend scale: cases', scale['cases'], 'deaths', scale['deaths'])
+
+		dates = [d for d in dates if d >= start_date]
+		print('Generating fixed maps for', len(dates), 'dates')
+		for d in dates:
+			self.set_nyt_date(d)
+			self.max_cases_per_Nsqmi = scale['cases']
+			self.max_deaths_per_Nsqmi = scale['deaths']
+			self.generate_map_cases()
+			self.generate_map_deaths()
+
+		if not os.path.exists(datacache.cache_dir):
+			os.makedirs(datacache.cache_dir)
+		datacache.write_meta(scale_file, scale)
+
+	# Return the legend scale for the fixed maps for |max_per_Nsqmi|, rounded up
+	# to the next FIXED_SCALE_STEP.
+	def calc_fixed_scale(self, max_per_Nsqmi):
+		if max_per_Nsqmi <= 0:
+			return max_per_Nsqmi
+		return 10 ** (math.ceil(math.log10(max_per_Nsqmi) / FIXED_SCALE_STEP) * FIXED_SCALE_STEP)
+
 	def generate_state_maps(self):		
 		for s in USInfo.STATES_WITH_MAPS:
 			self.generate_state_map(s, 'Cases', 'state/%s/map-cases.svg' % s, self.cases,
@@ -466,18 +636,12 @@ class MapData:
 		tags['%%LEGEND3%%'] = self.format_val(0.6, val_log_max)
 		tags['%%LEGEND4%%'] = self.format_val(0.4, val_log_max)
 		tags['%%LEGEND5%%'] = self.format_val(0.2, val_log_max)
+		tags['%%STATE%%'] = state_name
+		tags['%%URL%%'] = 'garykac.github.io/covid19/state/%s' % s
 
-		with open(in_svg) as fpin:
-			with open(out_svg, 'w') as fpout:
-				for line in fpin:
-					if line.startswith('  #INSERT_STYLES'):
-						self.write_css_styles(s, fpout, data, val_log_max, us_avg_log, False)
-					else:
-						tags['%%STATE%%'] = state_name
-						tags['%%URL%%'] = 'garykac.github.io/covid19/state/%s' % s
-
-						line = self.replace_tags(line, tags)
-						fpout.write(line)
+		styles = io.StringIO()
+		self.write_css_styles(s, styles, data, val_log_max, us_avg_log, False)
+		manifest.write_text(out_svg, self.get_svg_template(in_svg).generate(tags, styles.getvalue()))
 	
 	def calc_date_str(self):
 		d = self.curr_date
@@ -485,9 +649,10 @@ class MapData:
 		return d[8:10] + ' ' + months[int(d[5:7])-1] + ' ' + d[0:4]
 
 	def write_css_styles(self, state, fpout, data, val_log_max, us_avg_log, color_map_relative_to_us_avg):
-		state_fips = None
+		regions = data.keys()
 		if state != 'all':
 			state_fips = self.state2fips[USInfo.state_name[state]][0:2]
+			regions = [fips for fips in self.state_regions[state_fips] if fips in data]
 
 		if color_map_relative_to_us_avg:
 			self.write_color_style(fpout, 'legend-1', 1.0, color_map_relative_to_us_avg)
@@ -501,11 +666,7 @@ class MapData:
 			self.write_color_style(fpout, 'legend-3', 0.6, color_map_relative_to_us_avg)
 			self.write_color_style(fpout, 'legend-4', 0.4, color_map_relative_to_us_avg)
 			self.write_color_style(fpout, 'legend-5', 0.2, color_map_relative_to_us_avg)
-		for fips in data.keys():
-			# Ignore other states if we're writing data for a single state.
-			if state_fips != None and fips[0:2] != state_fips:
-				continue
-
+		for fips in regions:
 			# The CSS style id for coloring this region.
 			fips_style_id = fips
 
@@ -543,10 +704,10 @@ class MapData:
 					scaled_log = 1.0
 				self.write_color_style(fpout, 'c'+fips_style_id, scaled_log, color_map_relative_to_us_avg)
 	
-	def replace_tags(self, line, tags):
-		for t in tags:
-			line = line.replace(t, tags[t])
-		return line
+	def get_svg_template(self, filename):
+		if not filename in self.svg_templates:
+			self.svg_templates[filename] = SvgTemplate(filename)
+		return self.svg_templates[filename]
 
 	def format_val(self, percent, log_max):
 		val = (10 ** (percent * log_max)) / AREA_SCALE
@@ -565,6 +726,22 @@ class MapData:
 		return '%.2e' % val
 
 	def write_color_style(self, fp, name, value, color_map_relative_to_us_avg):
+		step = int(value * (COLOR_STEPS - 1) + 0.5)
+		if step < 0:
+			step = 0
+		elif step >= COLOR_STEPS:
+			step = COLOR_STEPS - 1
+		fp.write('  #%s {fill:%s;}\n' % (name, self.color_ramps[color_map_relative_to_us_avg][step]))
+
+	# Return the list of colors for each step in the color ramp.
+	def calc_color_ramp(self, color_map_relative_to_us_avg):
+		ramp = []
+		for step in range(0, COLOR_STEPS):
+			ramp.append(self.calc_color(step / (COLOR_STEPS - 1), color_map_relative_to_us_avg))
+		return ramp
+
+	# Return the color for |value| (0.0 - 1.0) as '#rrggbb'.
+	def calc_color(self, value, color_map_relative_to_us_avg):
 		if color_map_relative_to_us_avg:
 			# Only color areas that are above the US average
 			# US average = 0.5
@@ -576,9 +753,7 @@ class MapData:
 			# Covert value into gradient from white -> lt yellow -> orange -> red
 			rgb = colorsys.hsv_to_rgb((1.0 - value) * 0.225, value, 1.0)
 
-		color = "#{:02x}{:02x}{:02x}".format(int(255 * rgb[0]), int(255 * rgb[1]), int(255 * rgb[2]))
-		#print fips, self.deaths[fips], death_log, death_log_max, scaled_log, rgb, color
-		fp.write('  #%s {fill:%s;}\n' % (name, color))
+		return "#{:02x}{:02x}{:02x}".format(int(255 * rgb[0]), int(255 * rgb[1]), int(255 * rgb[2]))
 	
 	def animate(self):
 		self.animate_data('map-us-cases', 'us-cases')
@@ -597,7 +772,9 @@ class MapData:
 			# Record last file so that we can hold it longer at end of animation.
 			if png_file > last_file:
 				last_file = png_file
-			if os.path.exists(png_file):
+			# Only convert the svg files that have changed since the png was created.
+			if (os.path.exists(png_file) and not manifest.was_rebuilt(svg_file)
+					and os.path.getmtime(png_file) >= os.path.getmtime(svg_file)):
 				continue
 			print('    ', name)
 			subprocess.call(['svg2png', svg_file, '-o', png_file])
@@ -611,18 +788,22 @@ def usage():
 	print('  --help')
 	print('  --anim')
 	print('  --date yyyy-mm-dd')
+	print('  --date-range yyyy-mm-dd:yyyy-mm-dd  Generate US maps with fixed legend for each date in range')
 	print('  --fixed  Generate US map with fixed legend')
+	print('  --force  Regenerate all maps, even if they are up to date')
+	print('  --no-cache  Parse the input data files instead of using the cached data')
 	sys.exit(1)
 
 def main(argv):
 	try:
 		opts, args = getopt.getopt(argv,
 				"?had:f",
-				["?", "help", "anim", "date=", "fixed"])
+				["?", "help", "anim", "date=", "date-range=", "fixed", "force", "no-cache"])
 	except getopt.GetoptError:
 		usage()
 
 	process_date = None
+	start_date = None
 	animate = False
 	fixed = False
 	state = True
@@ -633,9 +814,21 @@ def main(argv):
 			animate = True
 		if opt in ("-d", "--date"):
 			process_date = arg
+		if opt == "--date-range":
+			if not ':' in arg:
+				usage()
+			(start_date, end_date) = arg.split(':')
+			if end_date:
+				process_date = end_date
+			fixed = True
+			state = False
 		if opt in ("-f", "--fixed"):
 			fixed = True
 			state = False
+		if opt == "--force":
+			manifest.enabled = False
+		if opt == "--no-cache":
+			datacache.enabled = False
 
 	map_data = MapData(fixed)
 	map_data.load_census()
@@ -643,14 +836,22 @@ def main(argv):
 	map_data.scan_svg()
 	map_data.check_data()
 
-	map_data.generate_map_cases()
-	map_data.generate_map_deaths()
+	if fixed:
+		# Without a date range, only generate the maps for the current date.
+		if start_date == None:
+			start_date = map_data.curr_date
+		map_data.generate_fixed_maps(start_date)
+	else:
+		map_data.generate_map_cases()
+		map_data.generate_map_deaths()
 
 	if state:
 		map_data.generate_state_maps()
 	
 	if animate:
 		map_data.animate()
+
+	manifest.report()
 		
 if __name__ == "__main__":
 	main(sys.argv[1:])
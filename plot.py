@@ -2,18 +2,21 @@ from __future__ import division
 
 import copy
 import datetime
+import functools
 import getopt
-import matplotlib.patheffects as PathEffects
-import matplotlib.pyplot as plt
+import hashlib
+import importlib.metadata
+import json
+import multiprocessing
+import numpy
 import operator
 import os
 import shutil
-import subprocess
 import sys
-from matplotlib.ticker import FuncFormatter
-from matplotlib.ticker import ScalarFormatter
-from matplotlib.ticker import LogFormatter
+from PIL import Image
 
+import datacache
+import manifest
 from usinfo import USInfo
 from covid_data import CovidData
 
@@ -22,10 +25,171 @@ _italy_pop = 60549600  # 2020 from https://en.wikipedia.org/wiki/Demographics_of
 # Number of states to include in plot
 _top_n = 8
 
+# Number of processes to use when generating plots.
+_num_jobs = 1
+
+# The tasks being run by |run_tasks|. The worker processes are forked after
+# this is set so that they can run the tasks by index, without the tasks (and
+# the data that they use) needing to be pickled.
+_tasks = []
+
+# matplotlib is imported by |load_matplotlib| when the first plot is generated,
+# so that generating only the data/html files doesn't pay for its startup.
+plt = None
+PathEffects = None
+FuncFormatter = None
+LineCollection = None
+Figure = None
+FrameCanvas = None
+
+def load_matplotlib():
+	global plt, PathEffects, FuncFormatter, LineCollection, Figure, FrameCanvas
+	if plt != None:
+		return
+	import matplotlib
+	matplotlib.use('Agg')
+	import matplotlib.patheffects
+	import matplotlib.pyplot
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	import matplotlib.collections
+	import matplotlib.figure
+	import matplotlib.ticker
+	plt = matplotlib.pyplot
+	PathEffects = matplotlib.patheffects
+	FuncFormatter = matplotlib.ticker.FuncFormatter
+	LineCollection = matplotlib.collections.LineCollection
+	Figure = matplotlib.figure.Figure
+
+	# Agg canvas that can save a figure as an RGBA array (appended to the list
+	# passed as the "file") so that animation frames can be rendered with the
+	# same layout as the saved plots (e.g., bbox_inches='tight') without writing
+	# files.
+	class FrameCanvas(FigureCanvasAgg):
+		filetypes = dict(FigureCanvasAgg.filetypes, rgba_array='RGBA array')
+
+		def print_rgba_array(self, frames, **kwargs):
+			FigureCanvasAgg.draw(self)
+			frames.append(numpy.array(self.buffer_rgba()))
+
+_matplotlib_version = None
+
+# Return the matplotlib version (without importing matplotlib).
+def get_matplotlib_version():
+	global _matplotlib_version
+	if _matplotlib_version == None:
+		_matplotlib_version = importlib.metadata.version('matplotlib')
+	return _matplotlib_version
+
+def run_task(index):
+	_tasks[index]()
+
+# Run each of the |tasks| (functions that take no args and generate a plot),
+# using a pool of |_num_jobs| processes if parallel jobs are enabled.
+# Each plot is generated from scratch, so the output is the same either way.
+# Tasks created by |new_task| are skipped if their outputs are up to date.
+def run_tasks(tasks):
+	global _tasks
+	tasks = [t for t in tasks if not is_task_current(t)]
+	if len(tasks) != 0:
+		# Import before forking so that each process doesn't need to.
+		load_matplotlib()
+	num_jobs = min(_num_jobs, len(tasks))
+	if num_jobs <= 1 or not 'fork' in multiprocessing.get_all_start_methods():
+		for t in tasks:
+			t()
+			record_task(t)
+		return
+
+	_tasks = tasks
+	try:
+		with multiprocessing.get_context('fork').Pool(num_jobs) as pool:
+			pool.map(run_task, range(len(tasks)), chunksize=1)
+	finally:
+		_tasks = []
+	# The manifest is only updated in this process.
+	for t in tasks:
+		record_task(t)
+
+# Return a task (for |run_tasks|) that calls |func| with |args| to generate
+# the |outputs|. |inputs| are all the data and parameters that the outputs
+# depend on, and are used to check whether the outputs are up to date in the
+# build manifest.
+def new_task(outputs, inputs, func, *args):
+	task = functools.partial(func, *args)
+	task.outputs = outputs
+	task.key = manifest.calc_key(get_code_key(), *inputs)
+	return task
+
+def is_task_current(task):
+	if not hasattr(task, 'outputs'):
+		return False
+	return manifest.is_current(task.outputs, task.key)
+
+def record_task(task):
+	if hasattr(task, 'outputs'):
+		manifest.record(task.outputs, task.key)
+
+_code_key = None
+
+# Return a key for the code that generates the plots, so that all the plots
+# are rebuilt when it changes.
+def get_code_key():
+	global _code_key
+	if _code_key == None:
+		files = [__file__, sys.modules[CovidData.__module__].__file__, sys.modules[USInfo.__module__].__file__]
+		_code_key = manifest.calc_key(manifest.calc_code_key(files), get_matplotlib_version())
+	return _code_key
+
+# Duration (in ms) of each frame in the animations, and of the last frame.
+_anim_frame_ms = 50
+_anim_last_frame_ms = 2400
+
+# First date to include in the animations.
+_anim_first_date = '20200316'
+
+# Number of fractional digits kept for the normalized (per million) values in
+# the exported plot data.
+_export_norm_digits = 2
+
 # Dummy object for passing option attributes.
 class Options(object):
 	pass
 
+# Return the cached RGBA frame from |filename|, or None if it isn't cached.
+def load_frame(filename):
+	if not os.path.exists(filename):
+		return None
+	try:
+		with Image.open(filename) as image:
+			return numpy.asarray(image.convert('RGBA'))
+	except (IOError, ValueError):
+		return None
+
+def save_frame(filename, frame):
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	# Write to a temp file first so that a partial file is never used.
+	tmp_file = '%s.%d.tmp' % (filename, os.getpid())
+	Image.fromarray(frame, 'RGBA').save(tmp_file, 'PNG', compress_level=1)
+	os.replace(tmp_file, filename)
+
+# Write the RGBA |frames| to |filename| as an animated GIF that holds the last
+# frame for longer.
+# The frames can have different sizes (since the plots are cropped to fit their
+# labels), so they are all drawn on a white background of the largest size.
+def write_gif(filename, frames):
+	width = max([f.shape[1] for f in frames])
+	height = max([f.shape[0] for f in frames])
+	images = []
+	for f in frames:
+		frame = Image.fromarray(f, 'RGBA')
+		image = Image.new('RGB', (width, height), 'white')
+		image.paste(frame, (0, 0), frame)
+		images.append(image)
+	durations = [_anim_frame_ms] * len(images)
+	durations[-1] = _anim_last_frame_ms
+	images[0].save(filename, save_all=True, append_images=images[1:],
+			duration=durations, loop=0, optimize=True)
+
 # Graph parameters for Reported Tests
 class C19Tests:
 	num_days = 155
@@ -145,6 +309,38 @@ class C19DeathsNorm:
 	
 	individual_title = 'COVID-19 %s Reported Deaths per Million'
 
+# Graph parameters for Currently Hospitalized
+class C19HospitalizedNorm:
+	num_days = 130
+	threshold = 10
+	y_min = threshold
+	y_max = 2000
+	title = 'COVID-19 US States Currently Hospitalized per Million'
+	subtitle = 'Since first day with %d hospitalized/million' % threshold
+	output_dir = 'hospitalized-norm'
+	output_filebase = 'hospitalized'
+	x_label = 'Days since %d hospitalized per million people' % threshold
+	y_label = 'Currently hospitalized per million people'
+
+	label = 'Currently Hospitalized (per capita)'
+	units = 'per million'
+
+# Graph parameters for Currently in ICU
+class C19IcuNorm:
+	num_days = 130
+	threshold = 1
+	y_min = threshold
+	y_max = 500
+	title = 'COVID-19 US States Currently in ICU per Million'
+	subtitle = 'Since first day with %d in ICU/million' % threshold
+	output_dir = 'icu-norm'
+	output_filebase = 'icu'
+	x_label = 'Days since %d in ICU per million people' % threshold
+	y_label = 'Currently in ICU per million people'
+
+	label = 'Currently in ICU (per capita)'
+	units = 'per million'
+
 	
 # The order in which colors are assigned to plot lines.
 color_order = [
@@ -174,8 +370,9 @@ line_colors = {
 }
 
 class CovidCases:
-	def __init__(self, covid_data):
+	def __init__(self, covid_data, num_days_for_ranking=31):
 		self.cdata = covid_data
+		self.num_days_for_ranking = num_days_for_ranking
 		date = covid_data.get_date()
 		if not date:
 			print('ERROR - Missing date')
@@ -188,6 +385,8 @@ class CovidCases:
 		self.plot_date = self.date
 		self.plot_date_str = self.calc_date_str(self.plot_date)
 		
+		self.state_templates = {}
+
 		self.info = {}
 		self.info[C19Cases.output_dir] = C19Cases
 		self.info[C19CasesNorm.output_dir] = C19CasesNorm
@@ -196,9 +395,14 @@ class CovidCases:
 		self.info[C19Tests.output_dir] = C19Tests
 		self.info[C19TestsNorm.output_dir] = C19TestsNorm
 		
-	def remove_last_day(self):
-		self.cdata.remove_last_day()
-		self.set_date(self.cdata.get_date())
+	# Return a copy of this object that plots the data as of |date|.
+	# The data is not copied, so this is cheap and leaves this object unchanged.
+	def as_of(self, date):
+		cases = copy.copy(self)
+		cases.cdata = self.cdata.as_of(date)
+		cases.state_templates = {}
+		cases.set_date(cases.cdata.get_date())
+		return cases
 
 	def set_date(self, date):
 		self.date = date
@@ -242,6 +446,24 @@ class CovidCases:
 					new_data.append(n)
 		return new_data
 
+	# Normalize data based on population, starting from the first day that is
+	# over the threshold. Days without data after that are NaN so that they are
+	# drawn as gaps in the line instead of shifting the later days.
+	def process_normalize_with_gaps(self, data, threshold, pop, filter=True):
+		new_data = []
+		num_valid = 0
+		for c in data:
+			if not c:
+				if new_data:
+					new_data.append(float('nan'))
+				continue
+			n = self.normalize_pop(c, pop)
+			if new_data or (not filter) or n >= threshold:
+				new_data.append(n)
+				num_valid = len(new_data)
+		# Drop the days at the end that have not been reported yet.
+		return new_data[:num_valid]
+
 	# Filter data by threshold.
 	def process_filter(self, data, threshold, pop, filter=True):
 		new_data = []
@@ -259,28 +481,36 @@ class CovidCases:
 		#formatter = LogFormatter(labelOnlyBase=False, minor_thresholds=(2, 0.4))
 		#ax.yaxis.set_minor_formatter(formatter)
 
+	# Return the options for the data used by plot |type| (e.g., 'cases-norm').
+	def new_options(self, type):
+		if type.startswith('tests'):
+			return self.new_tests_options()
+		if type.startswith('cases'):
+			return self.new_cases_options()
+		return self.new_deaths_options()
+
 	def new_tests_options(self):
 		options = Options()
-		options.state_data = self.cdata.get_state_tests_pn
-		options.state_data2 = self.cdata.get_state_tests_pnp
-		options.us_data = self.cdata.get_us_tests_pnp
-		options.italy_data = self.cdata.get_italy_tests
+		options.metric = 'tests_pn'
+		options.metric2 = 'tests_pnp'
+		options.us_metric = 'tests_pnp'
+		options.italy_metric = 'tests'
 		return options
 	
 	def new_cases_options(self):
 		options = Options()
-		options.state_data = self.cdata.get_state_cases
-		options.state_data2 = None
-		options.us_data = self.cdata.get_us_cases
-		options.italy_data = self.cdata.get_italy_cases
+		options.metric = 'cases'
+		options.metric2 = None
+		options.us_metric = 'cases'
+		options.italy_metric = 'cases'
 		return options
 
 	def new_deaths_options(self):
 		options = Options()
-		options.state_data = self.cdata.get_state_deaths
-		options.state_data2 = None
-		options.us_data = self.cdata.get_us_deaths
-		options.italy_data = self.cdata.get_italy_deaths
+		options.metric = 'deaths'
+		options.metric2 = None
+		options.us_metric = 'deaths'
+		options.italy_metric = 'deaths'
 		return options
 
 	# Generate main graphs for |plot_date|.
@@ -320,6 +550,25 @@ class CovidCases:
 		
 		self.calc_top_n_data(options)
 
+	# Calc plots for the hospitalization data. These are not included in the
+	# state rankings.
+	def calc_top_n_hospital(self):
+		self.hospital_plots = []
+		for info in [C19HospitalizedNorm, C19IcuNorm]:
+			options = Options()
+			if info == C19HospitalizedNorm:
+				options.metric = 'hospitalizedCurrently'
+			else:
+				options.metric = 'inIcuCurrently'
+			options.metric2 = None
+			options.us_metric = options.metric
+			options.italy_metric = None
+			options.info = info
+			options.processor = self.process_normalize_with_gaps
+			options.ranking = self.cdata.get_metric_rank(options.metric, True)
+			self.calc_top_n_data_scale(options, True, self.hospital_plots)
+			self.calc_top_n_data_scale(options, False, self.hospital_plots)
+
 	# Generate a linear and a log top-n graph.
 	def calc_top_n_data(self, options):
 		options.info = options.info_direct
@@ -335,7 +584,9 @@ class CovidCases:
 		self.calc_top_n_data_scale(options, False)
 
 	# Generate top-n graph.
-	def calc_top_n_data_scale(self, options, use_log_scale):
+	# If |plots| is given, the plot is recorded there instead of in the main set
+	# of top-n plots (and is not included in the ranking).
+	def calc_top_n_data_scale(self, options, use_log_scale, plots=None):
 		scale = 'Linear'
 		if use_log_scale:
 			scale = 'Log'
@@ -349,6 +600,9 @@ class CovidCases:
 		options.x_label = options.info.x_label
 		options.y_label = options.info.y_label
 		
+		if plots != None:
+			plots.append(copy.copy(options))
+			return
 		self.record_top_n_plots(options)
 		self.record_ranking(options)
 	
@@ -361,7 +615,7 @@ class CovidCases:
 		ranking_data = {}  # full data needed to calcuate ranking.
 		rank = 1
 		for state in options.ranking:
-			raw_data = options.state_data(state)
+			raw_data = self.cdata.get_state_data(options.metric, state)
 			data = options.processor(raw_data, options.info.threshold, USInfo.state_pop[state], False)
 			if len(data) > 0:
 				val = data[-1]
@@ -378,17 +632,25 @@ class CovidCases:
 		self.ranking[options.output_dir] = ranking
 		self.ranking_data[options.output_dir] = ranking_data
 
-	def generate_top_n_plots(self):
+	def generate_top_n_plots(self, plots=None):
+		run_tasks(self.top_n_plot_tasks(plots))
+
+	# Return the tasks to generate the top-n plots (see |run_tasks|).
+	# Progress is reported here since the tasks may be run in other processes.
+	def top_n_plot_tasks(self, plots=None):
+		if plots == None:
+			plots = self.top_n_plots
 		print('Generating top-n graphs for', self.date_str, end='')
 		self.last_print = 'xxx'
-		for options in self.top_n_plots:
-			self.generate_plot(options)
+		tasks = []
+		for options in plots:
+			self.print_plot_progress(options)
+			tasks.append(new_task(self.calc_plot_filenames(options), [self.calc_frame_key(options)],
+					self.generate_plot, options))
 		print()
-	
-	def generate_plot(self, options):
-		if not os.path.exists(options.output_dir):
-			os.makedirs(options.output_dir)
+		return tasks
 
+	def print_plot_progress(self, options):
 		new_plot_type = True
 		if options.output_dir.startswith(self.last_print):
 			if options.output_dir.endswith('-norm'):
@@ -405,6 +667,44 @@ class CovidCases:
 			self.last_print = options.output_dir
 		sys.stdout.flush()
 
+	def generate_plot(self, options):
+		self.draw_plot(options)
+
+		outdir = '%s/%s' % (options.output_dir, self.plot_date)
+		os.makedirs(outdir, exist_ok=True)
+
+		# Save with the figure rather than |plt.savefig|, which redraws the
+		# figure after saving it.
+		(filename, filename2) = self.calc_plot_filenames(options)
+		self.fig.savefig(filename, bbox_inches='tight')
+
+		# Make copies of the latest version in the top level dir.
+		shutil.copy(filename, filename2)
+
+	# Return the dated filename and the top level copy for the top-n plot.
+	def calc_plot_filenames(self, options):
+		suffix = self.calc_scale_suffix(options.use_log_scale)
+		return [
+			'%s/%s/%s-%s-%s.png' % (options.output_dir, self.plot_date, options.output_filebase, suffix, self.date),
+			'%s/%s-%s.png' % (options.output_dir, options.output_filebase, suffix),
+		]
+
+	# Return the plot for |options| as an RGBA array.
+	def render_frame(self, options):
+		self.draw_plot(options)
+		frames = []
+		FrameCanvas(self.fig)
+		self.fig.savefig(frames, format='rgba_array', bbox_inches='tight')
+		plt.close('all')
+		return frames[0]
+
+	def calc_scale_suffix(self, use_log_scale):
+		if use_log_scale:
+			return 'log'
+		return 'lin'
+
+	# Draw the top-n plot for |options| in a new figure.
+	def draw_plot(self, options):
 		plt.close('all')
 		self.fig, ax = plt.subplots()
 		ax.axis([0, options.max_days, options.y_min, options.y_max])
@@ -413,39 +713,27 @@ class CovidCases:
 		ax.set_xlabel(options.x_label)
 		ax.set_ylabel(options.y_label)
 		plt.title(options.title)
-		self.add_footer(plt, False)
+		self.add_footer(plt, False, options.italy_metric != None)
 
 		# Plot the top |_top_n| states.
 		for i in range(_top_n):
 			state = options.ranking[i];
-			self.plot_data(ax, options.state_data(state), color_order[i],
+			self.plot_data(ax, self.cdata.get_state_data(options.metric, state), color_order[i],
 					USInfo.state_pop[state], state, False,
 					options.processor, options.info.threshold)
 
-		self.plot_data(ax, options.italy_data(), 'black', _italy_pop, 'Italy', True,
-				options.processor, options.info.threshold)
-		self.plot_data(ax, options.us_data(), 'black', USInfo.us_pop, 'US', True,
+		if options.italy_metric:
+			self.plot_data(ax, self.cdata.get_italy_data(options.italy_metric), 'black', _italy_pop, 'Italy', True,
+					options.processor, options.info.threshold)
+		self.plot_data(ax, self.cdata.get_us_data(options.us_metric), 'black', USInfo.us_pop, 'US', True,
 				options.processor, options.info.threshold)
 
-		outdir = '%s/%s' % (options.output_dir, self.plot_date)
-		if not os.path.exists(outdir):
-			os.makedirs(outdir)
-
-		suffix = 'lin'
 		if options.use_log_scale:
-			suffix = 'log'
 			plt.legend(loc="lower right")
 		else:
 			plt.legend(loc="upper left")
-		
-		filename = '%s/%s-%s-%s.png' % (outdir, options.output_filebase, suffix, self.date)
-		plt.savefig(filename, bbox_inches='tight')
-
-		# Make copies of the latest version in the top level dir.
-		filename2 = '%s/%s-%s.png' % (options.output_dir, options.output_filebase, suffix)
-		shutil.copy(filename, filename2)
 
-	def add_footer(self, plt, has_pending):
+	def add_footer(self, plt, has_pending, has_italy=True):
 		# Left side
 		y = -40
 		if has_pending:
@@ -458,11 +746,12 @@ class CovidCases:
 				xy=(0,0), xycoords='axes fraction',
 				xytext=(-40, y), textcoords='offset points',
 				size=8, ha='left', va='top')
-		y -= 10
-		plt.annotate('Italy data from https://github.com/pcm-dpc/COVID-19',
-				xy=(0,0), xycoords='axes fraction',
-				xytext=(-40, y), textcoords='offset points',
-				size=8, ha='left', va='top')
+		if has_italy:
+			y -= 10
+			plt.annotate('Italy data from https://github.com/pcm-dpc/COVID-19',
+					xy=(0,0), xycoords='axes fraction',
+					xytext=(-40, y), textcoords='offset points',
+					size=8, ha='left', va='top')
 		
 		# Right side
 		y += 10
@@ -473,9 +762,11 @@ class CovidCases:
 
 	def generate_states_combined(self):
 		print('Generating combined state graphs')
-		self.generate_states_combined_tests()
-		self.generate_states_combined_cases()
-		self.generate_states_combined_deaths()
+		tasks = []
+		tasks.extend(self.generate_states_combined_tests())
+		tasks.extend(self.generate_states_combined_cases())
+		tasks.extend(self.generate_states_combined_deaths())
+		run_tasks(tasks)
 	
 	def generate_states_combined_tests(self):
 		print('  combined state tests')
@@ -484,8 +775,7 @@ class CovidCases:
 		options.ranking = self.cdata.get_test_rank_norm()
 		options.processor = self.process_normalize_and_filter
 
-		self.generate_states_combined_data(options, True)
-		self.generate_states_combined_data(options, False)
+		return self.states_combined_tasks(options)
 	
 	def generate_states_combined_cases(self):
 		print('  combined state cases')
@@ -494,8 +784,7 @@ class CovidCases:
 		options.ranking = self.cdata.get_case_rank_norm()
 		options.processor = self.process_normalize_and_filter
 
-		self.generate_states_combined_data(options, True)
-		self.generate_states_combined_data(options, False)
+		return self.states_combined_tasks(options)
 
 	def generate_states_combined_deaths(self):
 		print('  combined state deaths')
@@ -504,8 +793,16 @@ class CovidCases:
 		options.ranking = self.cdata.get_death_rank_norm()
 		options.processor = self.process_normalize_and_filter
 
-		self.generate_states_combined_data(options, True)
-		self.generate_states_combined_data(options, False)
+		return self.states_combined_tasks(options)
+
+	def states_combined_tasks(self, options):
+		data_key = manifest.calc_key(self.date_str, self.cdata.get_state_matrix(options.metric, False))
+		tasks = []
+		for use_log_scale in [True, False]:
+			filename = '%s/states-%s.png' % (options.info.output_dir, self.calc_scale_suffix(use_log_scale))
+			tasks.append(new_task([filename], [data_key, filename],
+					self.generate_states_combined_data, options, use_log_scale))
+		return tasks
 
 	def generate_states_combined_data(self, options, use_log_scale):
 		plt.close('all')
@@ -531,6 +828,10 @@ class CovidCases:
 			state_ax[state] = ax
 			s += 1
 
+		# The light gray reference lines for all the states are the same in each
+		# subplot, so calculate them once.
+		ref_lines = self.calc_line_vertices(options.metric, options.processor, options.info.threshold)
+
 		for s in USInfo.states:
 			ax = state_ax[s]
 			ax.axis([0, options.info.combined_num_days, options.info.y_min, options.info.combined_y_max])
@@ -542,19 +843,25 @@ class CovidCases:
 				ax.set_yticks(ticks)
 			
 			# Plot data for all the states in light gray for reference.
-			for s2 in USInfo.states:
-				self.plot_data(ax, options.state_data(s2), 'lt_gray',
-						USInfo.state_pop[s2], '', False, options.processor, options.info.threshold)	
-			self.plot_data(ax, options.state_data(s), 'dk_gray',
+			ax.add_collection(LineCollection(ref_lines, colors=line_colors['lt_gray'],
+					linewidths=1, capstyle='projecting', joinstyle='round', zorder=2))
+			self.plot_data(ax, self.cdata.get_state_data(options.metric, s), 'dk_gray',
 					USInfo.state_pop[s], s, True, options.processor, options.info.threshold)
 
 		fig.set_size_inches(8, 18)
-		suffix = 'lin'
-		if use_log_scale:
-			suffix = 'log'
-		plt.savefig('%s/states-%s.png' % (options.info.output_dir, suffix),
+		plt.savefig('%s/states-%s.png' % (options.info.output_dir, self.calc_scale_suffix(use_log_scale)),
 				dpi=150, bbox_inches='tight')
 	
+	# Return the vertices of the line for each state's |metric| data, for use in
+	# a LineCollection. States without data are skipped.
+	def calc_line_vertices(self, metric, processor, threshold):
+		lines = []
+		for s in USInfo.states:
+			data = processor(self.cdata.get_state_data(metric, s), threshold, USInfo.state_pop[s])
+			if len(data) > 0:
+				lines.append(numpy.column_stack([numpy.arange(len(data)), data]))
+		return lines
+
 	def add_combined_title(self, ax, title, sub):
 		ax.annotate(title,
 				xy=(1,1), xycoords='axes fraction',
@@ -582,36 +889,97 @@ class CovidCases:
 
 	def generate_states_individual(self):
 		print('Generating individual state graphs')
-		self.generate_states_individual_tests()
-		self.generate_states_individual_cases()
-		self.generate_states_individual_deaths()
+		tasks = []
+		tasks.extend(self.generate_states_individual_tests())
+		tasks.extend(self.generate_states_individual_cases())
+		tasks.extend(self.generate_states_individual_deaths())
+		run_tasks(tasks)
 	
 	def generate_states_individual_tests(self):
 		print('  individual state tests')
 		options = self.new_tests_options()
-		self.generate_states_individual_data(C19TestsNorm, options)
+		return self.generate_states_individual_data(C19TestsNorm, options)
 	
 	def generate_states_individual_cases(self):
 		print('  individual state cases')
 		options = self.new_cases_options()
-		self.generate_states_individual_data(C19CasesNorm, options)
+		return self.generate_states_individual_data(C19CasesNorm, options)
 		
 	def generate_states_individual_deaths(self):
 		print('  individual state deaths')
 		options = self.new_deaths_options()
-		self.generate_states_individual_data(C19DeathsNorm, options)
+		return self.generate_states_individual_data(C19DeathsNorm, options)
 		
+	# Return the tasks to generate the individual state plots.
 	def generate_states_individual_data(self, info, options):
 		options.output_filebase = info.output_filebase
 		options.processor = self.process_normalize_and_filter
 
+		inputs = [self.date_str, self.cdata.get_state_matrix(options.metric, False),
+				self.cdata.get_us_data(options.us_metric), self.cdata.get_italy_data(options.italy_metric)]
+		if options.metric2:
+			inputs.append(self.cdata.get_state_matrix(options.metric2, False))
+		data_key = manifest.calc_key(*inputs)
+
+		tasks = []
 		for state in USInfo.states:
-			self.generate_state(state, info, options, True)
-			self.generate_state(state, info, options, False)
+			for use_log_scale in [True, False]:
+				filename = self.calc_state_filename(state, info, use_log_scale)
+				tasks.append(new_task([filename], [data_key, filename],
+						self.generate_state, state, info, options, use_log_scale))
+		return tasks
+
+	# Note: Use |info.output_dir| as filename since we don't create subdir for states.
+	def calc_state_filename(self, state, info, use_log_scale):
+		return 'state/%s/%s-%s.png' % (state, info.output_dir, self.calc_scale_suffix(use_log_scale))
 	
 	def generate_state(self, state, info, options, use_log_scale):
-		plt.close('all')
-		self.fig, ax = plt.subplots()
+		template = self.get_state_template(info, options, use_log_scale)
+		ax = template.ax
+
+		scale = 'Linear'
+		if use_log_scale:
+			scale = 'Log'
+		title1 = info.individual_title % state
+		title = '%s\n(%s. %s scale)' % (title1, info.subtitle, scale)
+		ax.set_title(title)
+
+		days_plotted = self.update_series(template.state, self.cdata.get_state_data(options.metric, state),
+				USInfo.state_pop[state], state, True, options.processor, info.threshold)
+		if template.pending:
+			self.update_series(template.pending, self.cdata.get_state_data(options.metric2, state),
+					USInfo.state_pop[state], '', False, options.processor, info.threshold,
+					days_plotted)
+
+		output_dir = 'state/%s' % state
+		os.makedirs(output_dir, exist_ok=True)
+
+		if use_log_scale:
+			ax.legend(loc="lower right")
+		else:
+			ax.legend(loc="upper left")
+
+		template.fig.savefig(self.calc_state_filename(state, info, use_log_scale), bbox_inches='tight')
+
+	# Return the figure template for the individual state plots for |info|.
+	# The template is created the first time that it is needed and is reused for
+	# each state.
+	def get_state_template(self, info, options, use_log_scale):
+		key = (info.output_dir, use_log_scale)
+		if not key in self.state_templates:
+			self.state_templates[key] = self.new_state_template(info, options, use_log_scale)
+		return self.state_templates[key]
+
+	# Create a figure with everything that is the same in each individual state
+	# plot (axes, footer and the reference lines for all the states, US and
+	# Italy), with placeholders for the state being plotted.
+	# The figure isn't managed by pyplot so that it isn't closed by the other
+	# plots.
+	def new_state_template(self, info, options, use_log_scale):
+		template = Options()
+		template.fig = Figure()
+		ax = template.fig.subplots()
+		template.ax = ax
 		ax.axis([0, info.num_days, info.y_min, info.y_max])
 		self.format_axes(ax, use_log_scale)
 		ax.grid(True)
@@ -619,49 +987,77 @@ class CovidCases:
 		ax.set_ylabel(info.y_label)
 
 		has_pending_data = False
-		if options.state_data2:
+		if options.metric2:
 			has_pending_data = True
+		self.add_footer(ax, has_pending_data)
 
-		scale = 'Linear'
-		if use_log_scale:
-			scale = 'Log'
-		title1 = info.individual_title % state
-		title = '%s\n(%s. %s scale)' % (title1, info.subtitle, scale)
-		plt.title(title)
-		self.add_footer(plt, has_pending_data)
-	
 		# Plot data for all the states in light gray for reference.
 		for s2 in USInfo.states:
-			self.plot_data(ax, options.state_data(s2), 'lt_gray',
+			self.plot_data(ax, self.cdata.get_state_data(options.metric, s2), 'lt_gray',
 					USInfo.state_pop[s2], '', False, options.processor, info.threshold)
 
-		days_plotted = self.plot_data(ax, options.state_data(state), 'dk_blue',
-				USInfo.state_pop[state], state, True, options.processor, info.threshold)
+		# The state data needs to be added before the US/Italy data so that it
+		# is drawn (and listed in the legend) in the same order.
+		template.state = self.add_series(ax, 'dk_blue')
+		template.pending = None
 		if has_pending_data:
-			self.plot_data(ax, options.state_data2(state), 'dk_blue2',
-					USInfo.state_pop[state], '', False, options.processor, info.threshold,
-					days_plotted)
-		self.plot_data(ax, options.us_data(), 'black', USInfo.us_pop, 'US', True,
+			template.pending = self.add_series(ax, 'dk_blue2')
+
+		self.plot_data(ax, self.cdata.get_us_data(options.us_metric), 'black', USInfo.us_pop, 'US', True,
 				options.processor, info.threshold)
-		self.plot_data(ax, options.italy_data(), 'black', _italy_pop, 'Italy', True,
+		self.plot_data(ax, self.cdata.get_italy_data(options.italy_metric), 'black', _italy_pop, 'Italy', True,
 				options.processor, info.threshold)
+		return template
+
+	# Add an empty line (with a label) to |ax|, to be filled in by |update_series|.
+	def add_series(self, ax, color):
+		series = Options()
+		color, linewidth, linestyle = self.calc_line_style(color, '')
+		series.line, = ax.plot([], color=line_colors[color], linewidth = linewidth,
+				linestyle = linestyle, label = '')
+		series.labels = self.add_line_label(ax, 0, 0, '', color)
+		for text in series.labels:
+			text.set_visible(False)
+		return series
+
+	# Update the line in |series| to show |raw_data|.
+	# This is the same as |plot_data| for a line that has already been added.
+	def update_series(self, series, raw_data, pop, label, always_label, processor, threshold, max_days=None):
+		if max_days:
+			raw_data = raw_data[-max_days:]
+		processed_data = processor(raw_data, threshold, pop)
 
-		output_dir = 'state/%s' % state
-		if not os.path.exists(output_dir):
-			os.makedirs(output_dir)
+		series.line.set_data(range(len(processed_data)), processed_data)
+		series.line.set_label(label)
+		label_x, label_y = self.calc_label_pos(processed_data, threshold)
+		for text in series.labels:
+			text.set_position((label_x, label_y))
+			text.set_text(label)
+			text.set_visible(always_label or len(processed_data) > 0)
+		return len(processed_data)
 
-		suffix = 'lin'
-		if use_log_scale:
-			suffix = 'log'
-			plt.legend(loc="lower right")
-		else:
-			plt.legend(loc="upper left")
+	def plot_data(self, ax, raw_data, color, pop, label, always_label, processor, threshold, max_days=None):
+		color, linewidth, linestyle = self.calc_line_style(color, label)
 
-		# Note: Use |info.output_dir| as filename since we don't create subdir for states.
-		filename = '%s/%s-%s.png' % (output_dir, info.output_dir, suffix)
-		plt.savefig(filename, bbox_inches='tight')
+		# Clamp to max days so that data2 (eg: pending tests) aligns properly with data.
+		if max_days:
+			raw_data = raw_data[-max_days:]
+		processed_data = processor(raw_data, threshold, pop)
+		
+		# Always plot the data (even if empty) so that it gets added to the Legend.
+		# Otherwise the legend will jump when the images are stitched together for the
+		# animation.
+		ax.plot(processed_data, color=line_colors[color], linewidth = linewidth,
+				linestyle = linestyle, label = label)
+		if always_label or len(processed_data) > 0:
+			label_x, label_y = self.calc_label_pos(processed_data, threshold)
+			self.add_line_label(ax, label_x, label_y, label, color)
 
-	def plot_data(self, ax, raw_data, color, pop, label, always_label, processor, threshold, max_days=None):
+		# Return the number of days plotted.
+		return len(processed_data)
+
+	# Return the (color, linewidth, linestyle) for a line drawn in |color|.
+	def calc_line_style(self, color, label):
 		# Default to thick, solid line.
 		linewidth = 2
 		linestyle = '-'
@@ -678,72 +1074,106 @@ class CovidCases:
 		if color[-1] == '2':
 			color = color[0:-1]
 			linestyle = ':'  # Dotted
-
-		# Clamp to max days so that data2 (eg: pending tests) aligns properly with data.
-		if max_days:
-			raw_data = raw_data[-max_days:]
-		processed_data = processor(raw_data, threshold, pop)
-		
-		# Always plot the data (even if empty) so that it gets added to the Legend.
-		# Otherwise the legend will jump when the images are stitched together for the
-		# animation.
-		ax.plot(processed_data, color=line_colors[color], linewidth = linewidth,
-				linestyle = linestyle, label = label)
-		if always_label or len(processed_data) > 0:
-			# Label each line at its last data point.
-			if len(processed_data) > 0:
-				label_x = len(processed_data) - 1
-				label_y = processed_data[-1]
-			else:
-				label_x = 0
-				label_y = threshold
-			text_bg = ax.text(label_x, label_y, label, size=12)
-			text_bg.set_path_effects([
-					PathEffects.Stroke(linewidth=3, foreground='white'),
-					PathEffects.Normal()])
-			text = ax.text(label_x, label_y, label, size=12, color=line_colors[color])
-			text.set_path_effects([PathEffects.Normal()])
-
-		# Return the number of days plotted.
-		return len(processed_data)
-
+		return color, linewidth, linestyle
+
+	# Label each line at its last data point.
+	def calc_label_pos(self, processed_data, threshold):
+		if len(processed_data) > 0:
+			return len(processed_data) - 1, processed_data[-1]
+		return 0, threshold
+
+	# Add |label| at |x|,|y| and return the text artists.
+	def add_line_label(self, ax, x, y, label, color):
+		text_bg = ax.text(x, y, label, size=12)
+		text_bg.set_path_effects([
+				PathEffects.Stroke(linewidth=3, foreground='white'),
+				PathEffects.Normal()])
+		text = ax.text(x, y, label, size=12, color=line_colors[color])
+		text.set_path_effects([PathEffects.Normal()])
+		return [text_bg, text]
+
+	# Export the data for each type of plot (e.g., 'cases-norm') so that the
+	# plots can be drawn by the client. Each file contains the series for each
+	# state, the US and Italy, processed in the same way as for the plots (starting
+	# from the first day over the threshold and normalized by population for the
+	# '-norm' types).
+	#
+	# Values are stored as integers (scaled by |scale|) and delta-encoded: the
+	# first value is followed by the change from the previous day. The tests
+	# data also includes the |pending| series for each state, aligned with the
+	# last days of the state's main series.
+	def export_plot_data(self):
+		print('Exporting plot data')
+		os.makedirs('plot-data', exist_ok=True)
+		for type in sorted(self.info.keys()):
+			manifest.write_text('plot-data/%s.json' % type, self.calc_plot_data_json(type))
+
+	def calc_plot_data_json(self, type):
+		info = self.info[type]
+		options = self.new_options(type)
+		processor = self.process_filter
+		digits = 0
+		if type.endswith('-norm'):
+			processor = self.process_normalize_and_filter
+			digits = _export_norm_digits
+
+		series = {}
+		pending = {}
+		for s in USInfo.states:
+			pop = USInfo.state_pop[s]
+			data = processor(self.cdata.get_state_data(options.metric, s), info.threshold, pop)
+			series[s] = self.encode_series(data, digits)
+			if options.metric2:
+				# Clamp to the same days as the main series (see |update_series|).
+				raw_data = self.cdata.get_state_data(options.metric2, s)
+				if len(data) != 0:
+					raw_data = raw_data[-len(data):]
+				pending[s] = self.encode_series(processor(raw_data, info.threshold, pop), digits)
+		series['US'] = self.encode_series(processor(self.cdata.get_us_data(options.us_metric),
+				info.threshold, USInfo.us_pop), digits)
+		series['Italy'] = self.encode_series(processor(self.cdata.get_italy_data(options.italy_metric),
+				info.threshold, _italy_pop), digits)
+
+		data = {
+			'date': self.date,
+			'type': type,
+			'label': info.label,
+			'units': info.units,
+			'threshold': info.threshold,
+			'scale': 10 ** digits,
+			'series': series,
+		}
+		if options.metric2:
+			data['pending'] = pending
+		return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+	# Return |values| as delta-encoded integers with |digits| fractional digits.
+	def encode_series(self, values, digits):
+		if len(values) == 0:
+			return []
+		fixed = numpy.round(numpy.array(values, dtype=numpy.float64) * 10 ** digits).astype(numpy.int64)
+		return [int(fixed[0])] + numpy.diff(fixed).tolist()
+
+	# Calculate the state rankings for each day. The rankings cover the full
+	# history of the data and are stored with the most recent day first.
 	def calc_state_ranks(self):
 		self.rank_states = {}
 		self.rank_states_inv = {}
 		self.days_with_ranking_data = {}
-		self.num_states_for_ranking = 56
-		self.num_days_for_ranking = 31
+		self.num_states_for_ranking = len(USInfo.states)
 
-		ranking_data = copy.deepcopy(self.ranking_data)
 		for type in ['cases-norm', 'deaths-norm', 'tests-norm']:
-			data = ranking_data[type]
+			metric = self.new_options(type).metric
+			ranks = self.cdata.get_rank_matrix(metric, True)[::-1]
+			days = (self.cdata.get_state_matrix(metric, False) != 0).sum(axis=0)
 			rank_states = {}
 			rank_states_inv = {}
 			days_with_data = {}
-			for s in USInfo.states:
-				rank_states[s] = []
-				rank_states_inv[s] = []
-				days_with_data[s] = 0
-
-			for day in range(0, self.num_days_for_ranking):
-				# Get latest data for each state.
-				curr = {}
-				for s in USInfo.states:
-					if len(data[s]) != 0:
-						curr[s] = data[s][-1]
-						data[s].pop()
-						days_with_data[s] += 1
-					else:
-						curr[s] = 0
-
-				rank = []
-				for d in sorted(curr, key=curr.get, reverse=True):
-					rank.append(d)
-
-				for i in range(0, len(rank)):
-					s = rank[i]
-					rank_states_inv[s].append(self.num_states_for_ranking - i)
-					rank_states[s].append(i + 1)
+			for i in range(0, len(USInfo.states)):
+				s = USInfo.states[i]
+				rank_states[s] = ranks[:, i].tolist()
+				rank_states_inv[s] = (self.num_states_for_ranking + 1 - ranks[:, i]).tolist()
+				days_with_data[s] = int(days[i])
 
 			self.rank_states[type] = rank_states
 			self.rank_states_inv[type] = rank_states_inv
@@ -752,17 +1182,30 @@ class CovidCases:
 	def calc_ranking_plot(self):
 		print('Generating state ranking graphs')
 		print('  ', end='')
-		self.calc_ranking_plot_type('tests-norm', self.cdata.get_state_tests_pn)
-		self.calc_ranking_plot_type('cases-norm', self.cdata.get_state_cases)
-		self.calc_ranking_plot_type('deaths-norm', self.cdata.get_state_deaths)
+		tasks = []
+		tasks.extend(self.calc_ranking_plot_type('tests-norm', self.cdata.get_state_tests_pn))
+		tasks.extend(self.calc_ranking_plot_type('cases-norm', self.cdata.get_state_cases))
+		tasks.extend(self.calc_ranking_plot_type('deaths-norm', self.cdata.get_state_deaths))
 		print()
+		run_tasks(tasks)
 			
+	# Return the tasks to generate the ranking plots for |type|.
 	def calc_ranking_plot_type(self, type, raw_data):
 		print(type, end=' ')
 		sys.stdout.flush()
-		for s in USInfo.states:
-			self.calc_ranking_plot_type_state(type, s, raw_data)
-		self.calc_ranking_plot_type_state(type, 'all', raw_data)
+		data_key = manifest.calc_key(self.date, self.num_days_for_ranking,
+				self.cdata.get_state_matrix(self.new_options(type).metric, False))
+		tasks = []
+		for s in USInfo.states + ['all']:
+			filename = self.calc_ranking_filename(type, s)
+			tasks.append(new_task([filename], [data_key, filename],
+					self.calc_ranking_plot_type_state, type, s, raw_data))
+		return tasks
+
+	def calc_ranking_filename(self, type, state):
+		if state == 'all':
+			return 'state-ranking-%s.png' % type
+		return 'state/%s/state-ranking-%s.png' % (state, type)
 
 	def calc_ranking_plot_type_state(self, type, state, raw_data):
 		info = self.info[type]
@@ -823,87 +1266,120 @@ class CovidCases:
 			linewidth = 1
 			if s == state:
 				linewidth = 4
-			ax.plot(x[:days_with_data[s]], rank_states[s][:days_with_data[s]], linewidth = linewidth)
+			days = min(days_with_data[s], num_days)
+			ax.plot(x[:days], rank_states[s][:days], linewidth = linewidth)
 
-		if state == 'all':
-			filename = 'state-ranking-%s.png' % type
-		else:
-			filename = 'state/%s/state-ranking-%s.png' % (state, type)
 		fig.set_size_inches(24, 10)
-		plt.savefig(filename, dpi=90, bbox_inches='tight')
-		
-	def export_anim(self):
-		print('Exporting animations')
-		cmd = 'convert'
-		args_base = ['-delay', '5' ,'-loop', '0']
-
-		templates = []
-		for dir in ['tests', 'tests-norm']:
-			for f in ['tests-log', 'tests-lin']:
-				base_template = '%s%%s/%s' % (dir, f)
-				templates.append(base_template)
-		for dir in ['cases', 'cases-norm']:
-			for f in ['cases-log', 'cases-lin']:
-				base_template = '%s%%s/%s' % (dir, f)
-				templates.append(base_template)
-		for dir in ['deaths', 'deaths-norm']:
-			for f in ['deaths-log', 'deaths-lin']:
-				base_template = '%s%%s/%s' % (dir, f)
-				templates.append(base_template)
-
-		for t in templates:
-			print('  ', t)
-			filebase = t % ''
-			filebase_date = t % ('/' + self.plot_date)
-
-			args = args_base[:]
-			args.append('%s-2020*.png' % (filebase_date))
-			# Hold the last frame for a longer time.
-			args.extend(['-delay', '240'])
-			last_frame = '%s-%s.png' % (filebase_date, self.plot_date)
-			args.append(last_frame)
-			# Output file.
-			out_gif = '%s.gif' % (filebase_date)
-			args.append(out_gif)
-			subprocess.call([cmd] + args)
-
-			# Make copies of the latest version in the top level dir.
-			#shutil.copy(out_gif, '%s.gif' % (filebase))
-			#shutil.copy(last_frame, '%s.png' % (filebase))
+		plt.savefig(self.calc_ranking_filename(type, state), dpi=90, bbox_inches='tight')
 		
+	# Generate an animated GIF for each top-n plot showing the data for each
+	# day (using the top-n states from the most recent day).
+	# The frames are rendered in memory and each animation is a separate task
+	# so that they can be generated in parallel.
+	def generate_top_n_anims(self):
+		print('Generating top-n animations')
+		dates = [d for d in self.cdata.get_dates() if int(d) >= int(_anim_first_date)]
+		tasks = []
+		views = [self.as_of(d) for d in dates]
+		for options in self.top_n_plots:
+			print('  ', self.calc_anim_filename(options))
+			frame_keys = [v.calc_frame_key(options) for v in views]
+			tasks.append(new_task([self.calc_anim_filename(options)], frame_keys,
+					self.generate_anim, options, dates))
+		run_tasks(tasks)
+
+	def generate_anim(self, options, dates):
+		# Frames for previous days rarely change, so they are cached (as PNG
+		# files keyed by a hash of the frame's inputs). Frames that are no
+		# longer used are removed.
+		cache_dir = os.path.join(datacache.cache_dir, 'frames',
+				'%s-%s' % (options.output_dir, self.calc_scale_suffix(options.use_log_scale)))
+		frames = []
+		used = set()
+		num_rendered = 0
+		for date in dates:
+			view = self.as_of(date)
+			if not datacache.enabled:
+				frames.append(view.render_frame(options))
+				continue
+			key = view.calc_frame_key(options)
+			used.add(key + '.png')
+			frame = load_frame(os.path.join(cache_dir, key + '.png'))
+			if frame is None:
+				frame = view.render_frame(options)
+				save_frame(os.path.join(cache_dir, key + '.png'), frame)
+				num_rendered += 1
+			frames.append(frame)
+		if datacache.enabled:
+			for f in os.listdir(cache_dir):
+				if not f in used:
+					os.remove(os.path.join(cache_dir, f))
+			print('  ', self.calc_anim_filename(options), '- rendered', num_rendered,
+					'of', len(dates), 'frames')
+
+		outdir = '%s/%s' % (options.output_dir, self.plot_date)
+		os.makedirs(outdir, exist_ok=True)
+		write_gif(self.calc_anim_filename(options), frames)
+
+	# Return a hash of everything that the top-n plot for |options| depends on:
+	# the code that draws it, the plot parameters, the states being plotted and
+	# their data.
+	def calc_frame_key(self, options):
+		states = options.ranking[:_top_n]
+		params = [get_code_key(), self.date_str,
+				options.title, options.x_label, options.y_label,
+				options.y_min, options.y_max, options.max_days, options.use_log_scale,
+				options.info.threshold, options.processor.__name__, states,
+				options.metric, options.us_metric, options.italy_metric]
+		h = hashlib.sha1(repr(params).encode('utf-8'))
+		series = [self.cdata.get_state_data(options.metric, s) for s in states]
+		series.append(self.cdata.get_us_data(options.us_metric))
+		if options.italy_metric:
+			series.append(self.cdata.get_italy_data(options.italy_metric))
+		for data in series:
+			h.update(numpy.ascontiguousarray(data, dtype=numpy.int64).tobytes())
+		return h.hexdigest()
+
+	def calc_anim_filename(self, options):
+		return '%s/%s/%s-%s.gif' % (options.output_dir, self.plot_date,
+				options.output_filebase, self.calc_scale_suffix(options.use_log_scale))
+
 	def create_test_page_html(self):
 		print('Generating test page html files')
 
+		html = ''
 		with open('test-page-template.txt') as fpin:
-			with open('test-page.html', 'w') as fpout:
-				for line in fpin:
-					if '%%' in line:
-						line = line.replace('%%DATE%%', self.plot_date_str)
-						line = line.replace('%%YYYYMMDD%%', self.plot_date)
-					fpout.write(line)
+			for line in fpin:
+				if '%%' in line:
+					line = line.replace('%%DATE%%', self.plot_date_str)
+					line = line.replace('%%YYYYMMDD%%', self.plot_date)
+				html += line
+		manifest.write_text('test-page.html', html)
 
 	def create_state_html(self):
 		print('Generating state html files')
 
+		html = ''
 		with open('index-template.txt') as fpin:
-			with open('index.html', 'w') as fpout:
-				for line in fpin:
-					fpout.write(line.replace('%%DATE%%', self.plot_date_str))
+			for line in fpin:
+				html += line.replace('%%DATE%%', self.plot_date_str)
+		manifest.write_text('index.html', html)
 
 		for s in USInfo.states:
 			ranking = self.calc_ranking_for_state_html(s)
 			maps = ''
 			if s in USInfo.STATES_WITH_MAPS:
 				maps = self.calc_state_maps_html(s)
+			html = ''
 			with open('state-index-template.txt') as fpin:
-				with open('state/%s/index.html' % s, 'w') as fpout:
-					for line in fpin:
-						if '%%' in line:
-							line = line.replace('%%DATE%%', self.plot_date_str)
-							line = line.replace('%%STATE%%', USInfo.state_name[s])
-							line = line.replace('%%RANKING%%', ranking)
-							line = line.replace('%%MAPS%%', maps)
-						fpout.write(line)
+				for line in fpin:
+					if '%%' in line:
+						line = line.replace('%%DATE%%', self.plot_date_str)
+						line = line.replace('%%STATE%%', USInfo.state_name[s])
+						line = line.replace('%%RANKING%%', ranking)
+						line = line.replace('%%MAPS%%', maps)
+					html += line
+			manifest.write_text('state/%s/index.html' % s, html)
 
 	def calc_state_maps_html(self, state):
 		width = '550px'
@@ -997,16 +1473,25 @@ def usage():
 	print('  --anim Generate animated plots for top-N (implies --top)')
 	print('  --combined Generate combined state plots')
 	print('  --date <yyyymmdd> Only plot data up to date')
+	print('  --force Regenerate all outputs, even if they are up to date')
+	print('  --hospital Generate top-N plots for hospitalizations and ICU')
 	print('  --individual Generate individual state plots')
+	print('  --jobs <n> Number of processes to use for generating plots (default 1)')
+	print('  --no-export Don\'t export the state ranking CSV/HTML files or the plot data')
+	print('  --no-cache Parse the input data files and render all animation frames instead of using the cache')
 	print('  --ranking Generate state ranking plots')
+	print('  --ranking-days <n> Number of days to show in state ranking plots (default 31)')
 	print('  --top Generate state top-N plots')
 	sys.exit(1)
 
 def main(argv):
+	global _num_jobs
+
 	try:
 		opts, args = getopt.getopt(argv,
 				"?hancid:rt",
-				["?", "help", "all", "anim", "combined", "individual", "date=", "ranking", "top"])
+				["?", "help", "all", "anim", "combined", "individual", "date=", "force", "hospital", "jobs=", "no-cache", "no-export",
+				 "ranking", "ranking-days=", "top"])
 	except getopt.GetoptError:
 		usage()
 
@@ -1015,8 +1500,11 @@ def main(argv):
 	gen_combined = False
 	gen_individual = False
 	gen_top_n = False
+	gen_hospital = False
 	gen_ranking = False
 	gen_html = True
+	export_rankings = True
+	ranking_days = 31
 	for opt, arg in opts:
 		if opt in ("-?", "-h", "--?", "--help"):
 			usage()
@@ -1033,25 +1521,47 @@ def main(argv):
 			gen_combined = True
 		if opt in ("-d", "--date"):
 			date = arg
+		if opt == "--force":
+			manifest.enabled = False
+		if opt == "--hospital":
+			gen_hospital = True
 		if opt in ("-i", "--individual"):
 			gen_individual = True
+		if opt == "--jobs":
+			_num_jobs = int(arg)
+		if opt == "--no-cache":
+			datacache.enabled = False
+		if opt == "--no-export":
+			export_rankings = False
 		if opt in ("-r", "--ranking"):
 			gen_ranking = True
+		if opt == "--ranking-days":
+			ranking_days = int(arg)
 		if opt in ("-t", "--top"):
 			gen_top_n = True
 
 	covid_data = CovidData(date)
 	covid_data.load_data()
+
+	if export_rankings:
+		covid_data.export_rankings()
 	
-	cases = CovidCases(covid_data)
+	cases = CovidCases(covid_data, ranking_days)
 	print('Processing data for', cases.date_str)
 
 	# Calc plot data and ranking
 	cases.calc_top_n()
+
+	if export_rankings:
+		cases.export_plot_data()
 	
 	if gen_top_n:
 		cases.generate_top_n_plots()
 
+	if gen_hospital:
+		cases.calc_top_n_hospital()
+		cases.generate_top_n_plots(cases.hospital_plots)
+
 	if gen_combined:
 		cases.generate_states_combined()
 
@@ -1068,13 +1578,10 @@ def main(argv):
 		cases.create_test_page_html()
 		cases.create_state_html()
 	
-	# Note: Generating animated graphs modified the data in |covid_data|.
 	if gen_top_n and gen_animated:
-		# Process previous day data using top-N from current day.
-		while int(covid_data.get_date()) > int('20200316'):
-			cases.remove_last_day()
-			cases.generate_top_n_plots()
-		cases.export_anim()
+		cases.generate_top_n_anims()
+
+	manifest.report()
 
 if __name__ == "__main__":
 	main(sys.argv[1:])
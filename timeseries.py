@@ -0,0 +1,131 @@
+from __future__ import division
+
+import bisect
+import copy
+import numpy
+
+# Dense date x region x metric store for time series data.
+#
+# |values| holds the data for each (date, region, metric). Dates are sorted in
+# increasing order along the first axis and |date_index| maps each 'yyyymmdd'
+# date string to its position on that axis.
+#
+# Missing values are stored as 0 in |values| and flagged as True in |missing|.
+# Storing 0 (rather than None) means that the per-region series can be passed
+# directly to code that skips "empty" (falsy) days.
+class TimeSeriesStore:
+	def __init__(self, dates, regions, metrics, dtype=numpy.int64):
+		self.dates = list(dates)
+		self.regions = list(regions)
+		self.metrics = list(metrics)
+		self.date_index = self.build_index(self.dates)
+		self.region_index = self.build_index(self.regions)
+		self.metric_index = self.build_index(self.metrics)
+
+		shape = (len(self.dates), len(self.regions), len(self.metrics))
+		self.values = numpy.zeros(shape, dtype=dtype)
+		self.missing = numpy.ones(shape, dtype=bool)
+
+	def build_index(self, keys):
+		index = {}
+		for i in range(0, len(keys)):
+			index[keys[i]] = i
+		return index
+
+	def num_dates(self):
+		return len(self.dates)
+
+	def last_date(self):
+		if len(self.dates) == 0:
+			return None
+		return self.dates[-1]
+
+	def set(self, date, region, metric, value):
+		d = self.date_index[date]
+		r = self.region_index[region]
+		m = self.metric_index[metric]
+		self.values[d, r, m] = value
+		self.missing[d, r, m] = False
+
+	# Set all metrics for a batch of rows at once.
+	# |values| has one entry per row, with a value for each metric.
+	def set_rows(self, dates, regions, values):
+		if len(values) == 0:
+			return
+		d = [self.date_index[date] for date in dates]
+		r = [self.region_index[region] for region in regions]
+		self.values[d, r, :] = values
+		self.missing[d, r, :] = False
+
+	# Return the series for |region|/|metric| as a view into the store.
+	def series(self, region, metric):
+		return self.values[:, self.region_index[region], self.metric_index[metric]]
+
+	def series_missing(self, region, metric):
+		return self.missing[:, self.region_index[region], self.metric_index[metric]]
+
+	# Return the sum over all regions for |metric|, ignoring missing values.
+	def total(self, metric):
+		return self.values[:, :, self.metric_index[metric]].sum(axis=1)
+
+	# Return a date x region matrix for |metric| as a view into the store.
+	def metric_matrix(self, metric):
+		return self.values[:, :, self.metric_index[metric]]
+
+	def metric_missing(self, metric):
+		return self.missing[:, :, self.metric_index[metric]]
+
+	# Return a view of the store that contains only the dates up to and
+	# including |date|. The arrays are sliced (not copied) so this is cheap, and
+	# this store is unchanged.
+	def as_of(self, date):
+		end = bisect.bisect_right(self.dates, date)
+		view = copy.copy(self)
+		view.dates = self.dates[:end]
+		view.date_index = self.build_index(view.dates)
+		view.values = self.values[:end]
+		view.missing = self.missing[:end]
+		return view
+
+	# Add the dates from |other| (which must all be after the dates in this
+	# store) to the end of the store.
+	def append_store(self, other):
+		for d in other.dates:
+			self.date_index[d] = len(self.dates)
+			self.dates.append(d)
+		self.values = numpy.concatenate([self.values, other.values])
+		self.missing = numpy.concatenate([self.missing, other.missing])
+
+	# Return the contents of the store as a dict of arrays (for caching).
+	def to_arrays(self):
+		return {
+			'dates': numpy.array(self.dates, dtype=str),
+			'regions': numpy.array(self.regions, dtype=str),
+			'metrics': numpy.array(self.metrics, dtype=str),
+			'values': self.values,
+			'missing': self.missing,
+		}
+
+# Create a store from the arrays returned by |TimeSeriesStore.to_arrays|.
+# The values are not copied, so the arrays may be memory-mapped.
+def store_from_arrays(arrays):
+	store = TimeSeriesStore([], [], [])
+	store.dates = arrays['dates'].tolist()
+	store.regions = arrays['regions'].tolist()
+	store.metrics = arrays['metrics'].tolist()
+	store.date_index = store.build_index(store.dates)
+	store.region_index = store.build_index(store.regions)
+	store.metric_index = store.build_index(store.metrics)
+	store.values = arrays['values']
+	store.missing = arrays['missing']
+	return store
+
+# Return a matrix with the rank (1 = largest value) of each region for each
+# date in the date x region matrix |values|. Ties are ranked in region order.
+def calc_rank_matrix(values):
+	order = numpy.argsort(-values, axis=1, kind='stable')
+	ranks = numpy.empty(values.shape, dtype=numpy.int32)
+	num_regions = values.shape[1]
+	positions = numpy.arange(1, num_regions + 1, dtype=numpy.int32)
+	numpy.put_along_axis(ranks, order, numpy.broadcast_to(positions, values.shape), axis=1)
+	return ranks